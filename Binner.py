@@ -1,28 +1,46 @@
 import argparse
 import glob
+import itertools
+import h5py
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import rasterio
-import rasterstats
+import shapely
 from geopandas.tools import sjoin
-from rasterio.io import MemoryFile
+from rasterio.features import rasterize
 from rasterio.mask import mask
 from rasterio.warp import calculate_default_transform, reproject, Resampling
-from shapely.geometry import Polygon
 from shapely.geometry import mapping
+from Common import cache_key, cached, make_executor
+from Datacube import CUBE_CHUNKS, cube_days, cube_grid, read_days
+from Geodata import COUNTRY_SHAPEFILE, country_shape
+from Output_profile import DEFAULT_OUTPUT_PROFILE, add_output_profile_argument, profile_meta
+from Profiler import add_profile_argument, profiled, stage
 
+ZONAL_STATS = ['mean', 'sum', 'count', 'min', 'max', 'std']
+# rasterstats treats -999 as nodata when given an array without a nodata value
+ZONAL_NODATA = -999
+OUTPUT_FORMATS = ['shapefile', 'parquet']
+# Bin geometry of a plot worker process, set by init_plot_worker
+PLOT_BINS = None
+# {grid key: (gather index, labels, weights)} and the country shape, set once per worker by init_bin_worker
+BIN_GRIDS = None
+BIN_COUNTRY = None
 
-def crop_raster_with_shapefile(raster_path, country_shape, output_path):
-    with rasterio.open(raster_path) as src:
+
+def crop_raster_with_shapefile(raster_path, country_shape, output_path, output_profile=DEFAULT_OUTPUT_PROFILE):
+    with stage('crop', items=1) as crop, rasterio.open(raster_path) as src:
         country_shape = country_shape.to_crs(src.crs)
         out_image, out_transform = mask(src, [mapping(geom) for geom in country_shape.geometry], crop=True)
-        out_meta = src.meta.copy()
+        crop.add(nbytes=out_image.nbytes)
+        out_meta = profile_meta(src.meta, output_profile)
 
         out_meta.update({
-            "driver": "GTiff",
             "height": out_image.shape[1],
             "width": out_image.shape[2],
             "transform": out_transform
@@ -30,108 +48,452 @@ def crop_raster_with_shapefile(raster_path, country_shape, output_path):
 
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    with rasterio.open(output_path, "w", **out_meta) as dest:
+    with stage('write', items=1, nbytes=out_image.nbytes), rasterio.open(output_path, "w", **out_meta) as dest:
         dest.write(out_image[0], 1)
 
-def process_raster_data(selected_country, raster_paths, csv_path, output_dir, bin_size):
-    country_shapefile = 'Data/World_Countries/World_Countries_Generalized.shp'
-    shapefile = gpd.read_file(country_shapefile)
-    gdf = shapefile[shapefile['COUNTRY'] == selected_country]
-
-    if gdf.empty:
-        raise ValueError(f"No shape data found for the selected country: {selected_country}")
+def polygonal(pieces):
+    # Like overlay's keep_geom_type, keep only the polygon parts of each intersection
+    types = shapely.get_type_id(pieces)
+    for i in np.flatnonzero(types == 7):
+        parts = shapely.get_parts(pieces[i])
+        pieces[i] = shapely.union_all(parts[np.isin(shapely.get_type_id(parts), [3, 6])])
+    return np.isin(shapely.get_type_id(pieces), [3, 6]) & ~shapely.is_empty(pieces)
 
-    for raster_path in raster_paths:
-        cropped_raster_path = os.path.join(output_dir, os.path.basename(raster_path))
-        crop_raster_with_shapefile(raster_path, gdf, cropped_raster_path)
-
-    # Adjust bin_size from km to meters for CRS EPSG:3857
-    bin_size_m = bin_size * 1000
-    gdf = gdf.to_crs(epsg=3857)
 
+def build_zones(gdf, bin_size_m):
+    """
+    Cut the country into bin_size_m square bins, giving the same rows as gpd.overlay(gdf, grid).
+    """
     xmin, ymin, xmax, ymax = gdf.total_bounds
     rows = int(np.ceil((ymax - ymin) / bin_size_m))
     cols = int(np.ceil((xmax - xmin) / bin_size_m))
 
-    polygons = []
-    for x in range(cols):
-        for y in range(rows):
-            polygons.append(Polygon([(x * bin_size_m + xmin, y * bin_size_m + ymin),
-                                     ((x + 1) * bin_size_m + xmin, y * bin_size_m + ymin),
-                                     ((x + 1) * bin_size_m + xmin, (y + 1) * bin_size_m + ymin),
-                                     (x * bin_size_m + xmin, (y + 1) * bin_size_m + ymin)]))
-
-    grid = gpd.GeoDataFrame({'geometry': polygons}, crs='EPSG:3857')
-    intersection = gpd.overlay(gdf, grid, how='intersection')
-
-    # Process rasters
-    for raster_path in raster_paths:
-        with rasterio.open(raster_path) as src:
-            nodata_value = src.nodata if src.nodata else -32768
-            raster_data = src.read(1)
-            raster_data = np.where(raster_data == nodata_value, np.nan, raster_data)  # replace nodata with NaN
-
-            transform, width, height = calculate_default_transform(src.crs, intersection.crs, src.width, src.height,
-                                                                   *src.bounds)
-            kwargs = src.meta.copy()
-            kwargs.update({
-                'crs': intersection.crs,
-                'transform': transform,
-                'width': width,
-                'height': height
-            })
-
-            with MemoryFile() as memfile:
-                with memfile.open(**kwargs) as mem_dst:
-                    reproject(
-                        source=rasterio.band(src, 1),
-                        destination=rasterio.band(mem_dst, 1),
-                        src_transform=src.transform,
-                        src_crs=src.crs,
-                        dst_transform=transform,
-                        dst_crs=intersection.crs,
-                        resampling=Resampling.nearest
-                    )
-                reprojected_raster = memfile.open().read(1)
-
-            zonal_stats = rasterstats.zonal_stats(intersection, reprojected_raster, affine=transform, stats='mean')
-            raster_column_name = os.path.splitext(os.path.basename(raster_path))[0]
-            intersection[raster_column_name] = [stat['mean'] for stat in zonal_stats]
-
-    # Process CSV only if a path is provided
-    if csv_path:
-        df = pd.read_csv(csv_path)
-        gdf_points = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.longitude, df.latitude))
-        gdf_points.set_crs("EPSG:4326", inplace=True)
-        gdf_points = gdf_points.to_crs(epsg=3857)
-
-        joined = sjoin(gdf_points, intersection, how='inner')
-        for column in df.columns.difference(['longitude', 'latitude']):
-            mean_obs = joined.groupby('index_right')[column].mean()
-            intersection[column] = mean_obs
-
-    intersection.to_file(os.path.join(output_dir, 'intersection.shp'))
-
-    # Visualization
-    for column in [col for col in intersection.columns if col not in ['geometry']]:
+    # Cells are numbered column by column, as the grid has always been built
+    x, y = np.meshgrid(np.arange(cols), np.arange(rows), indexing='ij')
+    x, y = x.ravel(), y.ravel()
+    cells = shapely.box(x * bin_size_m + xmin, y * bin_size_m + ymin,
+                        (x + 1) * bin_size_m + xmin, (y + 1) * bin_size_m + ymin)
+    tree = shapely.STRtree(cells)
+
+    row_ids, geometries = [], []
+    for row_id, geom in enumerate(gdf.geometry.values):
+        shapely.prepare(geom)
+        hits = np.sort(tree.query(geom, predicate='intersects'))
+        # Cells well inside the border are kept whole, only border cells need an intersection
+        border = ~np.isin(hits, tree.query(geom, predicate='contains_properly'))
+        pieces = cells[hits].copy()
+        pieces[border] = shapely.intersection(pieces[border], geom)
+        keep = polygonal(pieces)
+        row_ids.append(np.full(keep.sum(), row_id))
+        geometries.append(pieces[keep])
+
+    zones = gdf.iloc[np.concatenate(row_ids)].reset_index(drop=True)
+    return zones.set_geometry(np.concatenate(geometries), crs=gdf.crs)
+
+
+def load_zones(gdf, selected_country, bin_size, cache_dir):
+    """
+    Return the country's bins clipped to its border in EPSG:3857, cached per (country, bin_size).
+    """
+    # Adjust bin_size from km to meters for CRS EPSG:3857
+    return cached(cache_dir, 'zones', (selected_country, bin_size, os.path.getmtime(COUNTRY_SHAPEFILE)),
+                  lambda: build_zones(gdf.to_crs(epsg=3857), bin_size * 1000),
+                  pd.read_pickle, lambda path, zones: zones.to_pickle(path), '.pkl')
+
+
+def load_zone_labels(zones, selected_country, bin_size, crs, transform, shape, cache_dir):
+    """
+    Rasterize the zones onto a raster grid as labels 1..n (0 outside every zone), cached per
+    (country, bin_size, crs, transform, shape).
+    """
+    def build():
+        projected = zones.to_crs(crs)
+        return rasterize(((geom, label) for label, geom in enumerate(projected.geometry, start=1)),
+                         out_shape=shape, transform=transform, fill=0, dtype='int32')
+
+    key_parts = (selected_country, bin_size, os.path.getmtime(COUNTRY_SHAPEFILE), crs, tuple(transform)[:6], shape)
+    return cached(cache_dir, 'labels', key_parts, build, np.load, np.save, '.npy')
+
+
+def load_gather_map(src_crs, src_transform, src_shape, dst_crs, cache_dir):
+    """
+    Work out once how a source grid maps onto dst_crs with nearest resampling, by letting GDAL warp
+    an array of flat pixel indices. Returns (dst_transform, index) where index holds, for every
+    destination pixel, the flat source index it takes its value from, or -1 outside the source.
+    Cached per (src crs, src transform, src shape, dst crs).
+    """
+    def build():
+        height, width = src_shape
+        left, top = src_transform * (0, 0)
+        right, bottom = src_transform * (width, height)
+        dst_transform, dst_width, dst_height = calculate_default_transform(
+            src_crs, dst_crs, width, height, left=min(left, right), bottom=min(top, bottom),
+            right=max(left, right), top=max(top, bottom))
+
+        # float64 holds every index exactly and is a type GDAL can always warp
+        source_index = np.arange(height * width, dtype=np.float64).reshape(src_shape)
+        index = np.full((dst_height, dst_width), -1, dtype=np.float64)
+        reproject(source=source_index, destination=index, src_transform=src_transform, src_crs=src_crs,
+                  src_nodata=-1, dst_transform=dst_transform, dst_crs=dst_crs, dst_nodata=-1,
+                  resampling=Resampling.nearest)
+        index = index.astype(np.int32 if height * width < 2 ** 31 else np.int64)
+        return {'transform': np.array(tuple(dst_transform)[:6]), 'index': index}
+
+    gather_map = cached(cache_dir, 'gather', (src_crs.to_wkt(), tuple(src_transform)[:6], src_shape, dst_crs), build)
+    return rasterio.Affine(*gather_map['transform']), gather_map['index']
+
+
+def gather(data, index, nodata):
+    """
+    Reproject data with a gather map from load_gather_map, filling pixels outside the source with
+    nodata (or 0 when there is none) as a nearest-neighbour warp does.
+    """
+    inside = index >= 0
+    out = np.full(index.shape, 0 if nodata is None else nodata, dtype=data.dtype)
+    out[inside] = data.ravel()[index[inside]]
+    return out
+
+
+def pixel_area_weights(crs, transform, shape):
+    """
+    Relative pixel areas of a grid, as a column broadcasting over its rows. On a geographic grid the
+    area of a pixel shrinks with cos(latitude); other grids are treated as equal area and get None.
+    """
+    if not crs.is_geographic:
+        return None
+    rows = np.arange(shape[0]) + 0.5
+    latitudes = transform.f + transform.e * rows + transform.d * 0.5
+    return np.cos(np.radians(latitudes))[:, np.newaxis]
+
+
+def zonal_statistics(values, labels, n_zones, stats=('mean',), nodata=ZONAL_NODATA, weights=None):
+    """
+    Compute stats for zones labelled 1..n_zones in a label array on the same grid as values, in one
+    bincount pass per statistic. Returns {stat: array of n_zones}, NaN for zones without valid pixels.
+    Optional weights (e.g. pixel areas, broadcastable to values) apply to mean and std.
+    """
+    valid = labels > 0
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    if nodata is not None:
+        valid &= values != nodata
+    zone = labels[valid]
+    data = values[valid].astype(np.float64)
+    weight = None if weights is None else np.broadcast_to(weights, values.shape)[valid].astype(np.float64)
+
+    count = np.bincount(zone, minlength=n_zones + 1)[1:]
+    empty = count == 0
+    results = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = np.bincount(zone, weights=data, minlength=n_zones + 1)[1:]
+        if weight is None:
+            weight_total, weighted, weighted_total = count, data, total
+        else:
+            weight_total = np.bincount(zone, weights=weight, minlength=n_zones + 1)[1:]
+            weighted = data * weight
+            weighted_total = np.bincount(zone, weights=weighted, minlength=n_zones + 1)[1:]
+        mean = np.where(empty, np.nan, weighted_total / weight_total)
+        for stat in stats:
+            if stat == 'count':
+                results[stat] = count
+            elif stat == 'sum':
+                results[stat] = np.where(empty, np.nan, total)
+            elif stat == 'mean':
+                results[stat] = mean
+            elif stat == 'std':
+                squares = np.bincount(zone, weights=weighted * data, minlength=n_zones + 1)[1:]
+                results[stat] = np.where(empty, np.nan, np.sqrt(np.maximum(squares / weight_total - mean * mean, 0)))
+            elif stat in ('min', 'max'):
+                extreme = np.full(n_zones + 1, np.inf if stat == 'min' else -np.inf)
+                (np.minimum if stat == 'min' else np.maximum).at(extreme, zone, data)
+                results[stat] = np.where(empty, np.nan, extreme[1:])
+            else:
+                raise ValueError(f"Unsupported statistic: {stat}")
+    return results
+
+
+def raster_date(raster_path):
+    """
+    Date part of a raster name such as 'Country_2022001.tif' or 'output_mean_2022-01.tif', or the whole
+    name when it does not end in a date.
+    """
+    name = os.path.splitext(os.path.basename(raster_path))[0]
+    date = name.rsplit('_', 1)[-1]
+    return date if date.replace('-', '').isdigit() else name
+
+
+class TimeseriesWriter:
+    """
+    Write zonal statistics in long format (bin_id, raster, stat, value) as one Parquet file per raster,
+    partitioned by date as timeseries/date=<date>/<raster>.parquet, so each raster is written as soon
+    as it is done and queries for one bin or one date only read what they need.
+    """
+
+    def __init__(self, output_dir):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow, install it with 'pip install pyarrow'.")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.folder = os.path.join(output_dir, 'timeseries')
+
+    def write(self, raster_path, zonal_stats):
+        stats = list(zonal_stats)
+        n_zones = len(zonal_stats[stats[0]])
+        name = os.path.splitext(os.path.basename(raster_path))[0]
+        # Rows are sorted by bin, so row group statistics let readers skip to a single bin
+        table = self.pa.table({
+            'bin_id': np.repeat(np.arange(n_zones, dtype=np.int32), len(stats)),
+            'raster': self.pa.array([name] * (n_zones * len(stats))).dictionary_encode(),
+            'stat': self.pa.array(stats * n_zones).dictionary_encode(),
+            'value': np.column_stack([np.asarray(zonal_stats[stat], dtype=np.float64) for stat in stats]).ravel(),
+        })
+        partition = os.path.join(self.folder, f'date={raster_date(raster_path)}')
+        os.makedirs(partition, exist_ok=True)
+        with stage('write', items=1, nbytes=table.nbytes):
+            self.pq.write_table(table, os.path.join(partition, f'{name}.parquet'))
+
+
+def raster_grid(src_crs, src_transform, src_shape, zones, selected_country, bin_size, cache_dir, native_crs):
+    """
+    Everything needed to bin rasters on a source grid: (gather index or None, labels, pixel weights).
+    Rasters sharing a grid share this, so it is built once per grid.
+    """
+    if native_crs:
+        crs, transform, shape, index = src_crs, src_transform, src_shape, None
+        weights = pixel_area_weights(src_crs, src_transform, shape)
+    else:
+        transform, index = load_gather_map(src_crs, src_transform, src_shape, zones.crs, cache_dir)
+        crs, shape, weights = zones.crs, index.shape, None
+    labels = load_zone_labels(zones, selected_country, bin_size, crs, transform, shape, cache_dir)
+    return index, labels, weights
+
+
+def init_bin_worker(grids, country_shape):
+    global BIN_GRIDS, BIN_COUNTRY
+    BIN_GRIDS = grids
+    BIN_COUNTRY = country_shape
+
+
+def bin_raster(raster_path, output_dir, grid_key, n_zones, stats, output_profile=DEFAULT_OUTPUT_PROFILE):
+    """
+    Crop one raster to the country into output_dir and compute its zonal statistics on the bins of
+    grid_key, returning {stat: array of n_zones}. Runs in a worker set up by init_bin_worker.
+    """
+    crop_raster_with_shapefile(raster_path, BIN_COUNTRY, os.path.join(output_dir, os.path.basename(raster_path)),
+                               output_profile)
+    index, labels, weights = BIN_GRIDS[grid_key]
+    with rasterio.open(raster_path) as src:
+        data = src.read(1)
+        if index is not None:
+            with stage('reproject', items=1, nbytes=data.nbytes):
+                data = gather(data, index, src.nodata)
+    with stage('zonal-stats', items=1, nbytes=data.nbytes):
+        return zonal_statistics(data, labels, n_zones, stats, weights=weights)
+
+
+def bin_cube_days(cube_path, day_indices, grid_key, n_zones, stats):
+    """
+    Compute the zonal statistics of some days of a datacube like bin_raster, returning a list with
+    one result per day. The days are read together, so a time chunk is only decompressed once.
+    """
+    index, labels, weights = BIN_GRIDS[grid_key]
+    with h5py.File(cube_path, 'r') as cube:
+        block = read_days(cube, day_indices)
+        nodata = cube_grid(cube)['nodata']
+    results = []
+    for data in block:
+        if index is not None:
+            with stage('reproject', items=1, nbytes=data.nbytes):
+                data = gather(data, index, nodata)
+        with stage('zonal-stats', items=1, nbytes=data.nbytes):
+            results.append(zonal_statistics(data, labels, n_zones, stats, weights=weights))
+    return results
+
+
+def init_plot_worker(geometry):
+    global PLOT_BINS
+    plt.switch_backend('Agg')
+    PLOT_BINS = gpd.GeoDataFrame(geometry=geometry)
+
+
+def plot_bins(column, values, output_dir):
+    with stage('plot', items=1):
+        bins = PLOT_BINS.assign(value=np.asarray(values))
         fig, ax = plt.subplots(1, 1, figsize=(10, 10))
-        intersection.plot(column=column, ax=ax, legend=True, edgecolor='black')
+        bins.plot(column='value', ax=ax, legend=True, edgecolor='black')
         plt.title(f'{column}')
-        plt.savefig(os.path.join(output_dir, f'{column}.png'))
+        fig.savefig(os.path.join(output_dir, f'{column}.png'))
+        plt.close(fig)
+
+
+class PlotStage:
+    """
+    Render bin maps in their own worker processes, with at most max_pending plots queued so that
+    a slow plot stage cannot pile up the values of every raster in memory.
+    """
+
+    def __init__(self, bins, output_dir, workers=1, max_pending=None):
+        self.output_dir = output_dir
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_plot_worker,
+                                            initargs=(bins.geometry,))
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+
+    def on_plotted(self, column, future):
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Failed to plot {column} due to {e}")
+        finally:
+            self.slots.release()
+
+    def submit(self, column, values):
+        self.slots.acquire()
+        future = self.executor.submit(plot_bins, column, values, self.output_dir)
+        future.add_done_callback(lambda f, column=column: self.on_plotted(column, f))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def process_raster_data(selected_country, raster_paths, csv_path, output_dir, bin_size, cache_dir=None,
+                        stats=('mean',), native_crs=False, output_format='shapefile', workers=1, plot=False,
+                        plot_workers=1, output_profile=DEFAULT_OUTPUT_PROFILE, datacube_path=None, first_day=None,
+                        last_day=None):
+    gdf = country_shape(selected_country)
+
+    if gdf.empty:
+        raise ValueError(f"No shape data found for the selected country: {selected_country}")
+
+    intersection = load_zones(gdf, selected_country, bin_size, cache_dir)
+
+    # Grids are prepared here, once each, so workers only gather and count. Every job is
+    # (raster file names, function, arguments) and the file names also name datacube days.
+    grids = {}
+    jobs = []
+    if datacube_path:
+        with h5py.File(datacube_path, 'r') as cube:
+            grid = cube_grid(cube)
+            src_crs = rasterio.crs.CRS.from_wkt(grid['crs'])
+            src_transform = rasterio.Affine(*grid['transform'])
+            key = cache_key(grid['crs'], tuple(grid['transform']), grid['height'], grid['width'])
+            grids[key] = raster_grid(src_crs, src_transform, (grid['height'], grid['width']), intersection,
+                                     selected_country, bin_size, cache_dir, native_crs)
+            # One job per time chunk of the cube, so each chunk is decompressed once
+            for _, chunk_days in itertools.groupby(cube_days(cube, first_day, last_day),
+                                                   key=lambda day: day[1] // CUBE_CHUNKS[0]):
+                chunk_days = list(chunk_days)
+                jobs.append(([f"{selected_country}_{day}.tif" for day, _ in chunk_days], bin_cube_days,
+                             (datacube_path, [index for _, index in chunk_days], key, len(intersection), stats)))
+    else:
+        raster_paths = sorted(raster_paths, key=lambda path: (raster_date(path), os.path.basename(path)))
+        for raster_path in raster_paths:
+            with rasterio.open(raster_path) as src:
+                key = cache_key(src.crs.to_wkt(), tuple(src.transform)[:6], src.shape)
+                if key not in grids:
+                    grids[key] = raster_grid(src.crs, src.transform, src.shape, intersection, selected_country,
+                                             bin_size, cache_dir, native_crs)
+            jobs.append(([os.path.basename(raster_path)], bin_raster,
+                         (raster_path, output_dir, key, len(intersection), stats, output_profile)))
+
+    writer = TimeseriesWriter(output_dir) if output_format == 'parquet' else None
+    plotter = PlotStage(intersection, output_dir, plot_workers) if plot else None
+    raster_columns = {}
+
+    try:
+        # Grids go to each worker once, tasks only name theirs
+        with make_executor(workers, init_bin_worker, (grids, gdf)) as executor:
+            futures = [executor.submit(function, *arguments) for _, function, arguments in jobs]
+            # Results are taken in date order as the workers finish them
+            for (raster_names, function, _), future in zip(jobs, futures):
+                results = future.result() if function is bin_cube_days else [future.result()]
+                for raster_name, zonal_stats in zip(raster_names, results):
+                    raster_column_name = os.path.splitext(raster_name)[0]
+                    if writer:
+                        writer.write(raster_name, zonal_stats)
+                    for stat in stats:
+                        # A mean-only run keeps the plain raster name as its column name
+                        column = raster_column_name if list(stats) == ['mean'] else f'{raster_column_name}_{stat}'
+                        if plotter:
+                            plotter.submit(column, zonal_stats[stat])
+                        if not writer:
+                            raster_columns[column] = zonal_stats[stat]
+                    print(f"Binned {raster_column_name}")
+
+        intersection = intersection.assign(**raster_columns)
+
+        # Process CSV only if a path is provided
+        if csv_path:
+            df = pd.read_csv(csv_path)
+            gdf_points = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.longitude, df.latitude))
+            gdf_points.set_crs("EPSG:4326", inplace=True)
+            gdf_points = gdf_points.to_crs(epsg=3857)
+
+            joined = sjoin(gdf_points, intersection, how='inner')
+            for column in df.columns.difference(['longitude', 'latitude']):
+                mean_obs = joined.groupby('index_right')[column].mean()
+                intersection[column] = mean_obs
+
+        with stage('write', items=1):
+            if writer:
+                # The bin geometry is stored once, timeseries rows refer to it by bin_id
+                intersection.insert(0, 'bin_id', np.arange(len(intersection), dtype=np.int32))
+                intersection.to_parquet(os.path.join(output_dir, 'bins.parquet'))
+            else:
+                intersection.to_file(os.path.join(output_dir, 'intersection.shp'))
+
+        # Visualization of the remaining columns, the raster columns were plotted as they came in
+        if plotter:
+            for column in intersection.columns:
+                if column not in ['geometry', 'bin_id'] and column not in raster_columns:
+                    plotter.submit(column, intersection[column].values)
+    finally:
+        if plotter:
+            plotter.close()
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Crop rasters to a specified country and optionally process CSV data.")
     parser.add_argument("--country", required=True, help="Name of the country for cropping.")
-    parser.add_argument("--raster-dir", required=True, help="Directory containing raster files.")
+    parser.add_argument("--raster-dir", help="Directory containing raster files.")
+    parser.add_argument("--datacube", default=None,
+                        help="Bin the days of this HDF5 datacube (see Downloader.py --datacube) instead of the "
+                             "rasters in --raster-dir.")
+    parser.add_argument("--first-day", default=None, help="With --datacube, the first day to bin as YYYYDDD.")
+    parser.add_argument("--last-day", default=None, help="With --datacube, the last day to bin as YYYYDDD.")
     parser.add_argument("--csv-path", help="Optional path to a CSV file for additional processing.")
     parser.add_argument("--output-dir", required=True, help="Output directory for processed files.")
     parser.add_argument("--bin-size", type=int, default=10, help="Bin size for the grid in kilometers. Default is 10km.")
+    parser.add_argument("--stats", nargs='+', default=['mean'], choices=ZONAL_STATS,
+                        help="Statistics computed for every bin and raster. Default is mean.")
+    parser.add_argument("--native-crs", action="store_true",
+                        help="Compute statistics on each raster's own grid instead of reprojecting it to EPSG:3857, "
+                             "weighting means by pixel area.")
+    parser.add_argument("--output-format", default='shapefile', choices=OUTPUT_FORMATS,
+                        help="Write one shapefile column per raster, or bins.parquet plus a long-format Parquet "
+                             "timeseries partitioned by date. Default is shapefile.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes cropping and binning rasters in parallel. Default is 1.")
+    parser.add_argument("--plot", action="store_true", help="Save a map of every column as a PNG.")
+    parser.add_argument("--plot-workers", type=int, default=1,
+                        help="Number of processes rendering plots when --plot is given. Default is 1.")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Folder for cached bin grids. Default is '.zone_cache' in the output directory.")
+    add_output_profile_argument(parser)
+    add_profile_argument(parser)
     return parser.parse_args()
 
 def main():
     args = parse_arguments()
-    raster_paths = glob.glob(os.path.join(args.raster_dir, '*.tif'))
-    process_raster_data(args.country, raster_paths, args.csv_path, args.output_dir, args.bin_size)
+    if not args.raster_dir and not args.datacube:
+        raise SystemExit("Either --raster-dir or --datacube is required.")
+    raster_paths = glob.glob(os.path.join(args.raster_dir, '*.tif')) if args.raster_dir else []
+    cache_dir = args.cache_dir or os.path.join(args.output_dir, '.zone_cache')
+    with profiled(args.profile):
+        process_raster_data(args.country, raster_paths, args.csv_path, args.output_dir, args.bin_size, cache_dir,
+                            args.stats, args.native_crs, args.output_format, args.workers, args.plot,
+                            args.plot_workers, args.output_profile, args.datacube, args.first_day, args.last_day)
     print("All processing completed successfully.")
 
 if __name__ == "__main__":
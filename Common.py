@@ -0,0 +1,45 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+
+def cache_key(*parts):
+    """Short, stable name for a cache file made from its inputs."""
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()[:16]
+
+
+def load_arrays(path):
+    with np.load(path) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+def save_arrays(path, arrays):
+    np.savez(path, **arrays)
+
+
+def cached(cache_dir, name, key_parts, build, load=load_arrays, save=save_arrays, extension='.npz'):
+    """
+    Return build(), cached in cache_dir as '<name>_<key><extension>' with the key made from key_parts.
+    A cached file is loaded with load(path) and a new one written with save(path, value), by default
+    a dict of arrays in an .npz file. Nothing is cached when cache_dir is None.
+    """
+    if not cache_dir:
+        return build()
+    path = os.path.join(cache_dir, f'{name}_{cache_key(*key_parts)}{extension}')
+    if os.path.exists(path):
+        return load(path)
+    value = build()
+    os.makedirs(cache_dir, exist_ok=True)
+    save(path, value)
+    return value
+
+
+def make_executor(workers, initializer=None, initargs=()):
+    """
+    A process pool of workers processes, or a single thread that keeps the work in this process
+    when only one worker is requested. initializer(*initargs) runs once in each worker.
+    """
+    if workers > 1:
+        return ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    return ThreadPoolExecutor(max_workers=1, initializer=initializer, initargs=initargs)
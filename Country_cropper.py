@@ -1,58 +1,129 @@
 import argparse
-import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 import rasterio
-from rasterio.mask import mask
+from rasterio.mask import raster_geometry_mask
+from rasterio.windows import Window
 from shapely.geometry import mapping
 import os
 import glob
-import tempfile
+from concurrent.futures import as_completed
+from Common import cache_key, cached, make_executor
+from Geodata import COUNTRY_SHAPEFILE, country_shape
+from Output_profile import DEFAULT_OUTPUT_PROFILE, add_output_profile_argument, profile_meta
+from Profiler import add_profile_argument, profiled, stage
 
-# Load the shapefile
-shapefile = gpd.read_file('Data/World_Countries/World_Countries_Generalized.shp')
+# {grid key: (shape_mask, out_transform, window)} of a cropping worker, set by init_crop_worker
+CROP_MASKS = None
 
 
-def crop_raster_with_shapefile(raster_path, country_shape, output_path):
+def country_mask(src, country_shape):
+    country_shape = country_shape.to_crs(src.crs)
+    return raster_geometry_mask(src, [mapping(geom) for geom in country_shape.geometry], crop=True)
+
+
+def load_country_mask(src, country_name, country_shape, cache_dir):
+    """
+    Return (shape_mask, out_transform, window) of the country on src's grid, cached per (country, grid).
+    """
+    def build():
+        shape_mask, out_transform, window = country_mask(src, country_shape)
+        return {'mask': shape_mask, 'transform': np.array(tuple(out_transform)[:6]),
+                'window': np.array([window.row_off, window.col_off, window.height, window.width])}
+
+    key_parts = (country_name, os.path.getmtime(COUNTRY_SHAPEFILE), src.crs.to_wkt(), tuple(src.transform)[:6],
+                 src.shape)
+    arrays = cached(cache_dir, 'mask', key_parts, build)
+    row_off, col_off, height, width = arrays['window']
+    return (arrays['mask'], rasterio.Affine(*arrays['transform']),
+            Window(int(col_off), int(row_off), int(width), int(height)))
+
+
+def crop_with_mask(raster_path, output_path, shape_mask, out_transform, window,
+                   output_profile=DEFAULT_OUTPUT_PROFILE):
     print(f"Cropping raster: {os.path.basename(raster_path)}")  # Print the name of the raster being cropped
-    with rasterio.open(raster_path) as src:
-        image_data = src.read(1) + 1
-        country_shape = country_shape.to_crs(src.crs)
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.tif') as temp_file:
-            with rasterio.open(temp_file.name, 'w', **src.meta) as temp_dst:
-                temp_dst.write(image_data, 1)
-
-            with rasterio.open(temp_file.name) as temp_src:
-                out_image, out_transform = mask(temp_src, [mapping(geom) for geom in country_shape.geometry], crop=True,
-                                                invert=False)
-                out_meta = temp_src.meta.copy()
-
-    out_meta.update(
-        {"driver": "GTiff", "height": out_image.shape[1], "width": out_image.shape[2], "transform": out_transform})
+    with stage('crop', items=1) as crop, rasterio.open(raster_path) as src:
+        # Read only the country's window and mask it in memory, giving the same values as mask() on the +1 raster
+        out_image = src.read(1, window=window, out_shape=shape_mask.shape) + 1
+        out_image[shape_mask] = src.nodata if src.nodata is not None else 0
+        out_meta = profile_meta(src.meta, output_profile)
+        crop.add(nbytes=out_image.nbytes)
+
+    out_meta.update({"height": out_image.shape[0], "width": out_image.shape[1], "transform": out_transform})
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with rasterio.open(output_path, "w", **out_meta) as dest:
-        dest.write(out_image[0], 1)
-    os.remove(temp_file.name)
+    with stage('write', items=1, nbytes=out_image.nbytes), rasterio.open(output_path, "w", **out_meta) as dest:
+        dest.write(out_image, 1)
+
+
+def init_crop_worker(masks):
+    global CROP_MASKS
+    CROP_MASKS = masks
+
 
+def crop_with_grid_mask(raster_path, output_path, grid, output_profile=DEFAULT_OUTPUT_PROFILE):
+    crop_with_mask(raster_path, output_path, *CROP_MASKS[grid], output_profile)
 
-def run(raster_dir, output_dir, country_name, view_rasters):
-    country = shapefile[shapefile['COUNTRY'] == country_name]
-    raster_files = glob.glob(os.path.join(raster_dir, '*.tif'))
 
+def crop_raster_with_shapefile(raster_path, country_shape, output_path, output_profile=DEFAULT_OUTPUT_PROFILE):
+    with rasterio.open(raster_path) as src:
+        shape_mask, out_transform, window = country_mask(src, country_shape)
+    crop_with_mask(raster_path, output_path, shape_mask, out_transform, window, output_profile)
+
+
+def is_up_to_date(raster_path, output_path):
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(raster_path)
+
+
+def view_raster(output_file):
+    with rasterio.open(output_file) as src:
+        img = src.read(1)
+    fig, (ax1, ax2) = plt.subplots(ncols=2, figsize=(12, 6))
+    ax1.imshow(img, cmap='turbo')
+    ax1.set_title("Standard")
+    ax2.imshow(np.log1p(img), cmap='turbo')
+    ax2.set_title("Log transformed")
+    plt.show()
+
+
+def run(raster_dir, output_dir, country_name, view_rasters, workers=1, cache_dir=None,
+        output_profile=DEFAULT_OUTPUT_PROFILE):
+    country = country_shape(country_name)
+    raster_files = sorted(glob.glob(os.path.join(raster_dir, '*.tif')))
+
+    # Masks are computed here, once per grid, so the workers only read, mask and write
+    masks = {}
+    jobs = []
     for raster_file in raster_files:
         output_file = os.path.join(output_dir, os.path.basename(raster_file))
-        crop_raster_with_shapefile(raster_file, country, output_file)
-
-        if view_rasters:
-            with rasterio.open(output_file) as src:
-                img = src.read(1)
-            fig, (ax1, ax2) = plt.subplots(ncols=2, figsize=(12, 6))
-            ax1.imshow(img, cmap='turbo')
-            ax1.set_title("Standard")
-            ax2.imshow(np.log1p(img), cmap='turbo')
-            ax2.set_title("Log transformed")
-            plt.show()
+        if is_up_to_date(raster_file, output_file):
+            print(f"Skipping {os.path.basename(raster_file)}, the cropped raster is up to date")
+            continue
+        with rasterio.open(raster_file) as src:
+            grid = cache_key(src.crs.to_wkt(), tuple(src.transform)[:6], src.shape)
+            if grid not in masks:
+                masks[grid] = load_country_mask(src, country_name, country, cache_dir)
+        jobs.append((raster_file, output_file, grid))
+
+    failed = []
+    # Masks go to each worker once, tasks only name their grid
+    with make_executor(workers, init_crop_worker, (masks,)) as executor:
+        futures = {executor.submit(crop_with_grid_mask, raster_file, output_file, grid, output_profile): raster_file
+                   for raster_file, output_file, grid in jobs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to crop {os.path.basename(futures[future])} due to {e}")
+                failed.append(futures[future])
+
+    if view_rasters:
+        for raster_file in raster_files:
+            output_file = os.path.join(output_dir, os.path.basename(raster_file))
+            if raster_file not in failed:
+                view_raster(output_file)
 
+    if failed:
+        print(f"Cropping failed for {len(failed)} rasters")
     print("All cropping operations completed!")  # Indicate when all cropping operations are complete
 
 
@@ -62,11 +133,19 @@ def parse_arguments():
     parser.add_argument("--output-dir", required=True, help="Directory to save cropped rasters.")
     parser.add_argument("--country", required=True, help="Name of the country to use for cropping.")
     parser.add_argument("--view-rasters", action='store_true', help="Set this flag to view rasters after cropping.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes cropping rasters in parallel.")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Folder for cached country masks. Default is '.mask_cache' in the output directory.")
+    add_output_profile_argument(parser)
+    add_profile_argument(parser)
     return parser.parse_args()
 
 def main():
     args = parse_arguments()
-    run(args.raster_dir, args.output_dir, args.country, args.view_rasters)
+    cache_dir = args.cache_dir or os.path.join(args.output_dir, '.mask_cache')
+    with profiled(args.profile):
+        run(args.raster_dir, args.output_dir, args.country, args.view_rasters, args.workers, cache_dir,
+            args.output_profile)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,121 @@
+import bisect
+import os
+import h5py
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+
+CUBE_DATASET = 'ntl'
+DAYS_DATASET = 'days'
+# Eight days of 256x256 pixels per chunk, so a month's stack or a pixel's time series reads a few
+# whole chunks, while a single day still only decompresses eight planes
+CUBE_CHUNKS = (8, 256, 256)
+
+
+def datacube_path(folder, country):
+    return os.path.join(folder, f"{country}_datacube.h5")
+
+
+def extent_grid(transform, bounds):
+    """
+    Return the (transform, height, width) of the pixels of transform's grid covering bounds
+    (west, south, east, north), expanded to whole pixels.
+    """
+    # A small tolerance keeps bounds that fall on a pixel edge from gaining a pixel to rounding
+    west, south, east, north = bounds
+    col_start = int(np.floor((west - transform.c) / transform.a + 1e-6))
+    col_stop = int(np.ceil((east - transform.c) / transform.a - 1e-6))
+    row_start = int(np.floor((north - transform.f) / transform.e + 1e-6))
+    row_stop = int(np.ceil((south - transform.f) / transform.e - 1e-6))
+    return (transform * rasterio.Affine.translation(col_start, row_start), row_stop - row_start,
+            col_stop - col_start)
+
+
+def create_cube(f, data, transform, crs, bounds, nodata=None):
+    transform, height, width = extent_grid(transform, bounds)
+    chunks = (CUBE_CHUNKS[0], min(CUBE_CHUNKS[1], height), min(CUBE_CHUNKS[2], width))
+    f.create_dataset(CUBE_DATASET, shape=(0, height, width), maxshape=(None, height, width), dtype=data.dtype,
+                     chunks=chunks, compression='gzip', compression_opts=4, shuffle=True,
+                     fillvalue=0 if nodata is None else nodata)
+    f.create_dataset(DAYS_DATASET, shape=(0,), maxshape=(None,), dtype='S7')
+    f.attrs['crs'] = CRS.from_user_input(crs).to_wkt()
+    f.attrs['transform'] = list(transform)[:6]
+    if nodata is not None:
+        f.attrs['nodata'] = nodata
+
+
+def write_day(path, day, data, transform, crs, bounds, nodata=None):
+    """
+    Store one day's (y, x) mosaic in the datacube at path under its 'YYYYDDD' day, replacing that day if
+    it is already there. Days are kept in date order, so a day arriving before later ones moves them up
+    one place. A new cube covers bounds (west, south, east, north), the full extent expected of a day,
+    on the pixel grid of the first day written. Days are placed by their transform, so mosaics missing
+    a tile still line up, and anything outside the grid is dropped.
+    """
+    with h5py.File(path, 'a') as f:
+        if CUBE_DATASET not in f:
+            create_cube(f, data, transform, crs, bounds, nodata)
+        cube = f[CUBE_DATASET]
+        days = f[DAYS_DATASET]
+        grid = rasterio.Affine(*f.attrs['transform'])
+        if not np.allclose((transform.a, transform.e), (grid.a, grid.e)):
+            raise ValueError(f"Day {day} has a different resolution than the datacube {path}")
+
+        existing = [d.decode() for d in days[...]]
+        if day in existing:
+            index = existing.index(day)
+        else:
+            index = bisect.bisect(existing, day)
+            count = len(existing)
+            cube.resize(count + 1, axis=0)
+            days.resize(count + 1, axis=0)
+            # Move the later days up from the end, a time chunk at a time
+            for stop in range(count, index, -CUBE_CHUNKS[0]):
+                start = max(index, stop - CUBE_CHUNKS[0])
+                cube[start + 1:stop + 1] = cube[start:stop]
+            days[index + 1:count + 1] = days[index:count]
+            days[index] = day.encode()
+
+        row = int(round((transform.f - grid.f) / grid.e))
+        col = int(round((transform.c - grid.c) / grid.a))
+        height, width = cube.shape[1:]
+        row_start, row_stop = max(row, 0), min(row + data.shape[0], height)
+        col_start, col_stop = max(col, 0), min(col + data.shape[1], width)
+        plane = np.full((height, width), cube.fillvalue, dtype=cube.dtype)
+        if row_stop > row_start and col_stop > col_start:
+            plane[row_start:row_stop, col_start:col_stop] = data[row_start - row:row_stop - row,
+                                                                  col_start - col:col_stop - col]
+        if (row_stop - row_start, col_stop - col_start) != data.shape:
+            print(f"⚠️ Day {day} extends beyond the datacube grid, the outside part was dropped.")
+        cube[index] = plane
+
+
+def cube_grid(f):
+    """
+    Grid of an open datacube, in the same form as Stacker.grid_of describes a raster.
+    """
+    cube = f[CUBE_DATASET]
+    return {'crs': f.attrs['crs'], 'transform': [float(v) for v in f.attrs['transform']],
+            'height': cube.shape[1], 'width': cube.shape[2], 'dtype': cube.dtype.name,
+            'nodata': f.attrs['nodata'].item() if 'nodata' in f.attrs else None}
+
+
+def cube_days(f, first_day=None, last_day=None):
+    """
+    Return [(day, index)] of the days in an open datacube, in date order, optionally limited to
+    first_day..last_day ('YYYYDDD', inclusive).
+    """
+    days = [d.decode() for d in f[DAYS_DATASET][...]]
+    return sorted((day, index) for index, day in enumerate(days)
+                  if (first_day is None or day >= first_day) and (last_day is None or day <= last_day))
+
+
+def read_days(f, indices, rows=slice(None), cols=slice(None)):
+    """
+    Read the (len(indices), rows, cols) block of an open datacube for the given day indices, in the
+    order given. h5py needs increasing indices, so they are read sorted and put back in order.
+    """
+    indices = np.asarray(indices)
+    order = np.argsort(indices)
+    block = f[CUBE_DATASET][indices[order].tolist(), rows, cols]
+    return block[np.argsort(order)]
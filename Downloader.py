@@ -1,28 +1,34 @@
 import argparse
-import contextlib
+import collections
+import hashlib
+import json
 import os
+import queue
 import re
-import shutil
-import ssl
 import sys
-import urllib.request
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from tkinter import filedialog
-import geopandas as gpd
 import h5py
+import numpy as np
 import rasterio
 import requests
-from rasterio.merge import merge
-from rasterio.transform import from_bounds
+from rasterio.transform import Affine
+from requests.adapters import HTTPAdapter
+from Common import cache_key, make_executor
+from Datacube import datacube_path, write_day
+from Geodata import TILES_SHAPEFILE, TILE_BOUNDARIES_SHAPEFILE, country_bounds, country_tiles, country_windows
+from Output_profile import DEFAULT_OUTPUT_PROFILE, add_output_profile_argument, profile_meta
+from Profiler import add_profile_argument, profiled, stage
 
 # Constants
 USERAGENT = 'tis/download.py_1.0--' + sys.version.replace('\n','').replace('\r','')
-
-# Load the shapefiles
-shapefile_path = 'Data/Black_Marble_IDs/Black_Marble_World_tiles.shp'
-boundary_shapefile_path = 'Data/Black_Marble_IDs/BlackMarbleTiles/BlackMarbleTiles.shp'
-shapefile = gpd.read_file(shapefile_path)
-boundary_shapefile = gpd.read_file(boundary_shapefile_path)
+CMR_SEARCH_URL = "https://cmr.earthdata.nasa.gov/search/granules.json"
+CMR_PAGE_SIZE = 2000
+CHUNK_SIZE = 1024 * 1024
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Download and process Black Marble Night Lights data.")
@@ -31,6 +37,33 @@ def parse_arguments():
     parser.add_argument("--country", required=True, help="Country name.")
     parser.add_argument("--destination-folder", required=True, help="Folder to save downloaded and processed files.")
     parser.add_argument("--token", required=True, help="Authentication token for downloading data.")
+    parser.add_argument("--download-workers", type=int, default=4,
+                        help="Number of files to download concurrently. Default is 4.")
+    parser.add_argument("--retries", type=int, default=5,
+                        help="Number of times to retry a failed download. Default is 5.")
+    parser.add_argument("--backoff", type=float, default=2.0,
+                        help="Base delay in seconds between retries, doubled on every attempt. Default is 2.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes converting days of .h5 files in parallel. Default is 1.")
+    parser.add_argument("--country-window", action='store_true',
+                        help="Only read the part of each tile covered by the country, so the output is already "
+                             "cropped to the country's bounding box.")
+    parser.add_argument("--pipeline", action='store_true',
+                        help="Build each day's mosaic as soon as all of its tiles are downloaded, "
+                             "instead of after the whole download.")
+    parser.add_argument("--max-pending-days", type=int, default=3,
+                        help="In pipeline mode, the number of days downloaded ahead of conversion. Default is 3.")
+    parser.add_argument("--search-window-days", type=int, default=31,
+                        help="Number of days covered by each CMR search query. Default is 31.")
+    parser.add_argument("--search-workers", type=int, default=4,
+                        help="Number of CMR search windows queried in parallel. Default is 4.")
+    parser.add_argument("--search-cache-dir", default=None,
+                        help="Folder for cached CMR search results. Default is '.cmr_cache' in the destination folder.")
+    parser.add_argument("--datacube", action='store_true',
+                        help="Append each day to one chunked HDF5 datacube, '<country>_datacube.h5' in the "
+                             "destination folder, instead of writing a GeoTIFF per day.")
+    add_output_profile_argument(parser)
+    add_profile_argument(parser)
     return parser.parse_args()
 
 def main():
@@ -41,120 +74,516 @@ def main():
     destination_folder = args.destination_folder
     token = args.token
 
-    bounding_box = get_bounding_box(selected_country, shapefile)
+    bounding_box = country_bounds(selected_country)
     collection_id = "C3365931269-LAADS"  # Updated collection ID for VNP46A2 version 2
 
-    urls = search_nasa_cmr(collection_id, start_date, end_date, bounding_box)
-    if urls:
-        download(urls, destination_folder, token, selected_country)
-    else:
-        print("No URLs found for the given parameters.")
+    cache_dir = args.search_cache_dir or os.path.join(destination_folder, '.cmr_cache')
+    with profiled(args.profile):
+        urls = search_nasa_cmr(collection_id, start_date, end_date, bounding_box, cache_dir=cache_dir,
+                               window_days=args.search_window_days, workers=args.search_workers)
+        if urls:
+            download(urls, destination_folder, token, selected_country,
+                     workers=args.download_workers, retries=args.retries, backoff=args.backoff,
+                     pipeline=args.pipeline, max_pending_days=args.max_pending_days,
+                     conversion_workers=args.workers, country_window=args.country_window,
+                     output_profile=args.output_profile, datacube=args.datacube)
+        else:
+            print("No URLs found for the given parameters.")
+
+def granule_h5_links(granule):
+    links = []
+    for link in granule.get('links', []):
+        href = link.get('href', '')
+        if href.startswith('https') and href.endswith('.h5') and href not in links:
+            links.append(href)
+    return links
+
+def query_cmr_range(session, collection_id, bbox_str, first_day, last_day, cmr_search_url=CMR_SEARCH_URL):
+    """
+    Query CMR for every granule between first_day and last_day (inclusive, 'YYYY-MM-DD') in one
+    search, following CMR-Search-After paging. Returns {day: [h5 urls]} for every day in the range.
+    """
+    days = {}
+    current = datetime.strptime(first_day, '%Y-%m-%d')
+    while current.strftime('%Y-%m-%d') <= last_day:
+        days[current.strftime('%Y-%m-%d')] = []
+        current += timedelta(days=1)
+
+    params = {
+        "collection_concept_id": collection_id,
+        "temporal": f"{first_day}T00:00:00Z,{last_day}T23:59:59Z",
+        "bounding_box": bbox_str,
+        "page_size": CMR_PAGE_SIZE,
+        "sort_key": "start_date"
+    }
+    search_after = None
+    while True:
+        headers = {'CMR-Search-After': search_after} if search_after else {}
+        response = session.get(cmr_search_url, params=params, headers=headers, timeout=120)
+        response.raise_for_status()
+        granules = response.json().get('feed', {}).get('entry', [])
+        for granule in granules:
+            day = granule.get('time_start', '')[:10]
+            # Granules that only touch the range at midnight belong to a neighbouring day
+            if day in days:
+                days[day].extend(href for href in granule_h5_links(granule) if href not in days[day])
+        search_after = response.headers.get('CMR-Search-After')
+        if not granules or not search_after:
+            break
+    return days
+
+def missing_windows(days, cached, window_days):
+    windows = []
+    run = []
+    for day in days:
+        if day not in cached:
+            run.append(day)
+        if run and (day in cached or len(run) == window_days or day == days[-1]):
+            windows.append((run[0], run[-1]))
+            run = []
+    return windows
+
+def load_search_cache(cache_path):
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            return json.load(f)['days']
+    return {}
 
-def get_bounding_box(country, gdf):
-    country_gdf = gdf[gdf['COUNTRY'] == country]
-    return country_gdf.total_bounds
+def save_search_cache(cache_path, collection_id, bbox_str, cached):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'collection_id': collection_id, 'bounding_box': bbox_str, 'days': cached}, f, sort_keys=True)
+    os.replace(tmp_path, cache_path)
 
-def search_nasa_cmr(collection_id, start_date, end_date, bounding_box):
-    cmr_search_url = "https://cmr.earthdata.nasa.gov/search/granules.json"
+def search_nasa_cmr(collection_id, start_date, end_date, bounding_box, cache_dir=None, window_days=31, workers=4,
+                    cmr_search_url=CMR_SEARCH_URL):
     bbox_str = f"{bounding_box[0]},{bounding_box[1]},{bounding_box[2]},{bounding_box[3]}"
-    h5_links = []
+    days = []
     current_date = start_date
-
     while current_date <= end_date:
-        target_date = current_date.strftime('%Y-%m-%d')
-        temporal_range = f"{target_date}T00:00:00Z,{target_date}T23:59:59Z"
-        params = {
-            "collection_concept_id": collection_id,
-            "temporal": temporal_range,
-            "bounding_box": bbox_str,
-            "page_size": 50
-        }
-        response = requests.get(cmr_search_url, params=params)
-
-        if response.status_code == 200:
-            granules = response.json().get('feed', {}).get('entry', [])
-            print(f"{target_date}: Found {len(granules)} granules")
-            for granule in granules:
-                for link in granule.get('links', []):
-                    href = link.get('href', '')
-                    if href.startswith('https') and href.endswith('.h5'):
-                        h5_links.append(href)
-                        print("Found URL:", href)
-        else:
-            print(f"Error on {target_date}: {response.status_code}", response.text)
+        days.append(current_date.strftime('%Y-%m-%d'))
         current_date += timedelta(days=1)
 
+    cache_path = None
+    if cache_dir:
+        key = cache_key(collection_id, bbox_str)
+        cache_path = os.path.join(cache_dir, f"cmr_{key}.json")
+    cached = load_search_cache(cache_path)
+
+    windows = missing_windows(days, cached, window_days)
+    cached_days = sum(1 for day in days if day in cached)
+    if cached_days:
+        print(f"Using cached search results for {cached_days} of {len(days)} days")
+
+    with stage('search', items=len(windows)), create_session({'user-agent': USERAGENT}, workers) as session, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(query_cmr_range, session, collection_id, bbox_str, first, last,
+                                   cmr_search_url): (first, last) for first, last in windows}
+        for future in as_completed(futures):
+            first, last = futures[future]
+            try:
+                results = future.result()
+            except requests.RequestException as e:
+                print(f"Error searching {first} to {last}: {e}")
+                continue
+            # Days without granules are not cached since recent data may still be published
+            cached.update({day: links for day, links in results.items() if links})
+
+    if cache_path and windows:
+        save_search_cache(cache_path, collection_id, bbox_str, cached)
+
+    h5_links = []
+    for day in days:
+        links = cached.get(day, [])
+        print(f"{day}: Found {len(links)} granule files")
+        h5_links.extend(links)
     return h5_links
 
-def download(urls, destination_folder, token, selected_country):
+def download(urls, destination_folder, token, selected_country, workers=4, retries=5, backoff=2.0,
+             pipeline=False, max_pending_days=3, conversion_workers=1, country_window=False,
+             output_profile=DEFAULT_OUTPUT_PROFILE, datacube=False):
     print("Download Started.")
-    ctx = ssl.create_default_context()
     headers = {'user-agent': USERAGENT, 'Authorization': f'Bearer {token}'}
-    start_download_thread(urls, headers, ctx, destination_folder, selected_country)
+    if pipeline:
+        start_pipeline(urls, headers, destination_folder, selected_country, workers, retries, backoff,
+                       max_pending_days, conversion_workers, country_window, output_profile, datacube)
+    else:
+        start_download_thread(urls, headers, destination_folder, selected_country, workers, retries, backoff,
+                              conversion_workers, country_window, output_profile, datacube)
+
+def create_session(headers, pool_size):
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_complete(dest, expected_size=None, checksum=None):
+    if not os.path.exists(dest):
+        return False
+    if expected_size is not None and os.path.getsize(dest) != expected_size:
+        return False
+    if checksum is not None and file_md5(dest) != checksum.lower():
+        return False
+    return True
+
+def remote_size(session, url):
+    response = session.head(url, allow_redirects=True, timeout=60)
+    if response.status_code != 200 or 'Content-Length' not in response.headers:
+        return None
+    return int(response.headers['Content-Length'])
+
+def is_transient(error):
+    """
+    Whether a failed download may succeed when retried: a dropped connection, a timeout, a retryable
+    HTTP status or a checksum mismatch. Other client errors, such as a bad token (401) or a missing
+    granule (404), fail the same way every time.
+    """
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUS_CODES
+    if isinstance(error, requests.RequestException):
+        return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+    return True
 
-def start_download_thread(urls, headers, ctx, destination_folder, selected_country):
-    for url in urls:
-        filename = url.split('/')[-1]
-        dest = os.path.join(destination_folder, filename)
+def download_file(session, url, destination_folder, retries=5, backoff=2.0, checksum=None):
+    """
+    Download a single URL into destination_folder and return the number of bytes transferred.
+
+    A complete file already on disk is skipped. Partial downloads are kept as '<name>.part' and
+    resumed with an HTTP Range request on the next attempt or the next run.
+    """
+    filename = url.split('/')[-1]
+    dest = os.path.join(destination_folder, filename)
+    part = dest + '.part'
+
+    for attempt in range(retries + 1):
         try:
-            req = urllib.request.Request(url, headers=headers)
-            with urllib.request.urlopen(req, context=ctx) as response, open(dest, 'wb') as out_file:
-                shutil.copyfileobj(response, out_file)
+            if os.path.exists(dest):
+                if is_complete(dest, remote_size(session, url), checksum):
+                    print(f"Skipping {filename}: already downloaded")
+                    return 0
+                os.remove(dest)
+
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            transferred = 0
+            with stage('download', items=1) as downloading, \
+                    session.get(url, headers=headers, stream=True, timeout=300) as response:
+                if response.status_code in RETRY_STATUS_CODES:
+                    raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+                # 416 means the partial file already holds the whole body
+                if response.status_code != 416:
+                    response.raise_for_status()
+                    # A server that ignores the Range header sends the whole file again
+                    mode = 'ab' if offset and response.status_code == 206 else 'wb'
+                    with open(part, mode) as out_file:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            out_file.write(chunk)
+                            transferred += len(chunk)
+                downloading.add(nbytes=transferred)
+
+            if checksum is not None and file_md5(part) != checksum.lower():
+                os.remove(part)
+                raise IOError(f"checksum mismatch for {filename}")
+            os.replace(part, dest)
             print(f"Successfully downloaded {filename}")
-        except Exception as e:
-            print(f'Failed to download {url} due to {e}')
-            continue
+            return transferred
+        except (requests.RequestException, IOError) as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"Retrying {filename} in {delay:.0f}s after error: {e}")
+            time.sleep(delay)
+
+def download_all(urls, headers, destination_folder, workers=4, retries=5, backoff=2.0, checksums=None):
+    """
+    Download urls concurrently over a pooled session. Returns (downloaded paths, failed urls, bytes).
+    """
+    os.makedirs(destination_folder, exist_ok=True)
+    checksums = checksums or {}
+    downloaded, failed = [], []
+    total_bytes = 0
+    start = time.monotonic()
+
+    with create_session(headers, workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download_file, session, url, destination_folder, retries, backoff,
+                                   checksums.get(url)): url for url in urls}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                transferred = future.result()
+            except Exception as e:
+                print(f'Failed to download {url} due to {e}')
+                failed.append(url)
+                continue
+            total_bytes += transferred
+            downloaded.append(os.path.join(destination_folder, url.split('/')[-1]))
+
+    report_throughput(total_bytes, time.monotonic() - start, len(downloaded), len(failed))
+    return downloaded, failed, total_bytes
+
+def report_throughput(total_bytes, elapsed, downloaded, failed):
+    rate = total_bytes / elapsed / 1e6 if elapsed > 0 else 0.0
+    print(f"Downloaded {total_bytes / 1e6:.1f} MB in {elapsed:.1f}s ({rate:.2f} MB/s), "
+          f"{downloaded} files ok, {failed} failed.")
+
+def start_download_thread(urls, headers, destination_folder, selected_country, workers=4, retries=5, backoff=2.0,
+                          conversion_workers=1, country_window=False, output_profile=DEFAULT_OUTPUT_PROFILE,
+                          datacube=False):
+    download_all(urls, headers, destination_folder, workers, retries, backoff)
 
     print('Download of all files completed.')
     print('Please Wait. Converting and Merging .h5 files into Geo.tifs...')
-    process_h5_files(shapefile_path, boundary_shapefile_path, selected_country, destination_folder, destination_folder)
+    process_h5_files(TILES_SHAPEFILE, TILE_BOUNDARIES_SHAPEFILE, selected_country, destination_folder,
+                     destination_folder, conversion_workers, country_window, output_profile, datacube)
     print('Processing complete!')
 
-def process_h5_files(country_shapefile_path, boundary_shapefile_path, selected_country, input_folder, output_folder):
-    selected_rows = shapefile[shapefile['COUNTRY'] == selected_country.strip()]
+def start_pipeline(urls, headers, destination_folder, selected_country, workers=4, retries=5, backoff=2.0,
+                   max_pending_days=3, conversion_workers=1, country_window=False,
+                   output_profile=DEFAULT_OUTPUT_PROFILE, datacube=False):
+    """
+    Download and convert at the same time. Days are downloaded in order, and once every tile of a day
+    has arrived the day is queued for conversion, which writes the mosaic and deletes its .h5 files.
+    A day with tiles that failed to download is not converted and its .h5 files are kept, so it can be
+    completed and converted later. At most max_pending_days days are on disk at once, so it should be
+    at least conversion_workers.
+    """
+    os.makedirs(destination_folder, exist_ok=True)
+    tile_bounds, epsg = country_tiles(selected_country)
+    read_bounds = country_windows(selected_country, tile_bounds) if country_window else None
+    cube_path = datacube_path(destination_folder, selected_country) if datacube else None
+    extent = day_extent(tile_bounds, read_bounds)
+    urls_by_day = {}
+    for url in sorted(urls, key=lambda u: day_of(u.split('/')[-1])):
+        urls_by_day.setdefault(day_of(url.split('/')[-1]), []).append(url)
+
+    day_slots = threading.BoundedSemaphore(max_pending_days)
+    ready_days = queue.Queue(maxsize=max_pending_days)
+    remaining = {}
+    arrived = {}
+    missing = {}
+    incomplete_days = []
+    stats = {'bytes': 0, 'ok': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def on_converted(day, files, future):
+        try:
+            result = future.result()
+            if cube_path:
+                append_to_datacube(cube_path, day, result, files, destination_folder, epsg, extent)
+            print(f"Converted day {day}")
+        except Exception as e:
+            print(f"Failed to convert day {day} due to {e}")
+        finally:
+            day_slots.release()
+
+    def convert_days():
+        with make_executor(conversion_workers) as executor:
+            while True:
+                item = ready_days.get()
+                if item is None:
+                    break
+                day, files, failed = item
+                if failed:
+                    print(f"⚠️ Day {day} is incomplete: {failed} of its tiles failed to download, "
+                          f"its .h5 files are kept.")
+                    incomplete_days.append(day)
+                if failed or not files:
+                    day_slots.release()
+                    continue
+                try:
+                    future = executor.submit(process_day, day, files, selected_country, destination_folder,
+                                             destination_folder, tile_bounds, epsg, read_bounds, output_profile,
+                                             cube_path is not None)
+                except Exception as e:
+                    # A broken pool fails every later day the same way, which keeps the queue draining
+                    print(f"Failed to convert day {day} due to {e}")
+                    day_slots.release()
+                    continue
+                future.add_done_callback(lambda f, day=day, files=files: on_converted(day, files, f))
+
+    def on_downloaded(day, url, future):
+        with lock:
+            try:
+                stats['bytes'] += future.result()
+                stats['ok'] += 1
+                arrived[day].append(url.split('/')[-1])
+            except Exception as e:
+                print(f'Failed to download {url} due to {e}')
+                stats['failed'] += 1
+                missing[day] += 1
+            remaining[day] -= 1
+            day_complete = remaining[day] == 0
+        if day_complete:
+            ready_days.put((day, arrived.pop(day), missing.pop(day)))
+
+    converter = threading.Thread(target=convert_days)
+    converter.start()
+    start = time.monotonic()
+    try:
+        with create_session(headers, workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+            for day, day_urls in urls_by_day.items():
+                # Wait for a free slot so downloads never run more than max_pending_days ahead
+                day_slots.acquire()
+                with lock:
+                    remaining[day] = len(day_urls)
+                    arrived[day] = []
+                    missing[day] = 0
+                for url in day_urls:
+                    future = executor.submit(download_file, session, url, destination_folder, retries, backoff)
+                    future.add_done_callback(lambda f, day=day, url=url: on_downloaded(day, url, f))
+        report_throughput(stats['bytes'], time.monotonic() - start, stats['ok'], stats['failed'])
+    finally:
+        ready_days.put(None)
+        converter.join()
+    if incomplete_days:
+        print(f"{len(incomplete_days)} days were not converted because tiles failed to download: "
+              f"{', '.join(sorted(incomplete_days))}")
+    print('Processing complete!')
+
+def day_of(filename):
+    return re.search(r'\.A(\d+)\.', filename).group(1)
+
+def process_h5_files(country_shapefile_path, boundary_shapefile_path, selected_country, input_folder, output_folder,
+                     workers=1, country_window=False, output_profile=DEFAULT_OUTPUT_PROFILE, datacube=False):
+    tile_bounds, epsg = country_tiles(selected_country)
+    read_bounds = country_windows(selected_country, tile_bounds) if country_window else None
+    cube_path = datacube_path(output_folder, selected_country) if datacube else None
+    extent = day_extent(tile_bounds, read_bounds)
     files = [f for f in os.listdir(input_folder) if f.endswith('.h5')]
     files_by_day = {}
     for file in files:
-        day = re.search('\.A(\d+)\.', file).group(1)
-        files_by_day.setdefault(day, []).append(file)
+        files_by_day.setdefault(day_of(file), []).append(file)
 
-    for day, files in files_by_day.items():
-        rasters = []
-        for file in files:
-            tile_id = re.search('h\d{2}v\d{2}', file).group()
-            shape = selected_rows[selected_rows['TileID'] == tile_id]
-            if not shape.empty:
-                with h5py.File(os.path.join(input_folder, file), "r") as f:
-                    ntl_path = "/HDFEOS/GRIDS/VIIRS_Grid_DNB_2d/Data Fields/Gap_Filled_DNB_BRDF-Corrected_NTL"
-                    if ntl_path not in f:
-                        print(f"⚠️ Skipping {file}: dataset not found.")
-                        continue
+    failed_days = []
+    with make_executor(workers) as executor:
+        futures = collections.deque(
+            (day, executor.submit(process_day, day, files_by_day[day], selected_country, input_folder, output_folder,
+                                  tile_bounds, epsg, read_bounds, output_profile, cube_path is not None))
+            for day in sorted(files_by_day))
+        # Results are taken in date order, so days are appended to the datacube in order, and each is
+        # let go once handled so finished mosaics do not pile up
+        while futures:
+            day, future = futures.popleft()
+            try:
+                result = future.result()
+                if cube_path:
+                    append_to_datacube(cube_path, day, result, files_by_day[day], input_folder, epsg, extent)
+            except Exception as e:
+                print(f"Failed to convert day {day} due to {e}")
+                failed_days.append(day)
+
+    if failed_days:
+        print(f"Conversion failed for {len(failed_days)} days: {', '.join(sorted(failed_days))}")
+
+def tile_window(tile_bounds, read_bounds, shape):
+    """
+    Return the (row_start, row_stop, col_start, col_stop) pixel window of a tile covering read_bounds,
+    expanded to whole pixels, and the bounds of that window.
+    """
+    left, bottom, right, top = tile_bounds
+    res_x = (right - left) / shape[1]
+    res_y = (top - bottom) / shape[0]
+    west, south, east, north = read_bounds
+    col_start = min(max(int(np.floor((west - left) / res_x)), 0), shape[1])
+    col_stop = min(max(int(np.ceil((east - left) / res_x)), 0), shape[1])
+    row_start = min(max(int(np.floor((top - north) / res_y)), 0), shape[0])
+    row_stop = min(max(int(np.ceil((top - south) / res_y)), 0), shape[0])
+    bounds = (left + col_start * res_x, top - row_stop * res_y, left + col_stop * res_x, top - row_start * res_y)
+    return (row_start, row_stop, col_start, col_stop), bounds
+
+def mosaic_tiles(tiles):
+    """
+    Place (array, (left, bottom, right, top)) tiles into one preallocated array. The 10x10 degree tiles
+    sit on a fixed grid, so each one lands at a whole-pixel offset. This reproduces rasterio.merge.merge:
+    the first tile's resolution, the union of bounds, zero fill for gaps and the first tile winning overlaps.
+    """
+    first, (left, bottom, right, top) = tiles[0]
+    res_x = (right - left) / first.shape[1]
+    res_y = (top - bottom) / first.shape[0]
+    west = min(bounds[0] for _, bounds in tiles)
+    south = min(bounds[1] for _, bounds in tiles)
+    east = max(bounds[2] for _, bounds in tiles)
+    north = max(bounds[3] for _, bounds in tiles)
+
+    width = int(round((east - west) / res_x))
+    height = int(round((north - south) / res_y))
+    mosaic = np.zeros((1, height, width), dtype=first.dtype)
+    for data, (left, bottom, right, top) in reversed(tiles):
+        col = int(round((left - west) / res_x))
+        row = int(round((north - top) / res_y))
+        mosaic[0, row:row + data.shape[0], col:col + data.shape[1]] = data
+
+    return mosaic, Affine.translation(west, north) * Affine.scale(res_x, -res_y)
+
+def process_day(day, files, selected_country, input_folder, output_folder, tile_bounds, epsg, read_bounds=None,
+                output_profile=DEFAULT_OUTPUT_PROFILE, to_datacube=False):
+    tiles = []
+    for file in sorted(files):
+        tile_id = re.search('h\d{2}v\d{2}', file).group()
+        if tile_id in tile_bounds:
+            with stage('convert', items=1) as converting, h5py.File(os.path.join(input_folder, file), "r") as f:
+                ntl_path = "/HDFEOS/GRIDS/VIIRS_Grid_DNB_2d/Data Fields/Gap_Filled_DNB_BRDF-Corrected_NTL"
+                if ntl_path not in f:
+                    print(f"⚠️ Skipping {file}: dataset not found.")
+                    continue
+                if read_bounds is None:
                     ntl_data = f[ntl_path][...]
-                    boundary_shape = boundary_shapefile[boundary_shapefile['TileID'] == tile_id]
-                    left, bottom, right, top = boundary_shape.total_bounds
-                    temp_file = os.path.join(input_folder, f"temp_{tile_id}.tif")
-                    with rasterio.open(temp_file, "w", driver="GTiff",
-                                       height=ntl_data.shape[0], width=ntl_data.shape[1], count=1,
-                                       dtype=ntl_data.dtype, crs=shape.crs.to_epsg(),
-                                       transform=from_bounds(left, bottom, right, top,
-                                                             ntl_data.shape[1], ntl_data.shape[0])) as dst:
-                        dst.write(ntl_data, 1)
-                    rasters.append(temp_file)
-
-        with contextlib.ExitStack() as stack:
-            files_to_merge = [stack.enter_context(rasterio.open(raster)) for raster in rasters]
-            merged, transform = merge(files_to_merge)
-
-        for raster in rasters:
-            os.remove(raster)
-
-        output_file = os.path.join(output_folder, f"{selected_country}_{day}.tif")
-        with rasterio.open(output_file, "w", driver="GTiff", height=merged.shape[1],
-                           width=merged.shape[2], count=1, dtype=merged.dtype,
-                           crs=shape.crs.to_epsg(), transform=transform) as dest:
-            dest.write(merged)
-            for file in files:
-                os.remove(os.path.join(input_folder, file))
+                    bounds = tile_bounds[tile_id]
+                else:
+                    # Read only the hyperslab covering the country
+                    window, bounds = tile_window(tile_bounds[tile_id], read_bounds[tile_id], f[ntl_path].shape)
+                    row_start, row_stop, col_start, col_stop = window
+                    if row_stop <= row_start or col_stop <= col_start:
+                        continue
+                    ntl_data = f[ntl_path][row_start:row_stop, col_start:col_stop]
+                converting.add(nbytes=ntl_data.nbytes)
+            tiles.append((ntl_data, bounds))
+
+    if not tiles:
+        print(f"⚠️ Skipping day {day}: no tiles found for {selected_country}.")
+        return
+
+    with stage('mosaic', items=len(tiles), nbytes=sum(data.nbytes for data, _ in tiles)):
+        merged, transform = mosaic_tiles(tiles)
+    if to_datacube:
+        # HDF5 takes one writer at a time, so the mosaic goes back to the parent to be appended
+        return merged[0], transform
+
+    output_file = os.path.join(output_folder, f"{selected_country}_{day}.tif")
+    meta = profile_meta({'height': merged.shape[1], 'width': merged.shape[2], 'count': 1, 'dtype': merged.dtype,
+                         'crs': epsg, 'transform': transform}, output_profile)
+    with stage('write', items=1, nbytes=merged.nbytes), rasterio.open(output_file, "w", **meta) as dest:
+        dest.write(merged)
+        for file in files:
+            os.remove(os.path.join(input_folder, file))
+
+def day_extent(tile_bounds, read_bounds=None):
+    """
+    Return the (west, south, east, north) bounds of a day's mosaic when every tile has arrived.
+    """
+    boxes = [box for box in (read_bounds or tile_bounds).values()
+             if not np.isnan(box).any() and box[2] > box[0] and box[3] > box[1]]
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes), max(box[2] for box in boxes),
+            max(box[3] for box in boxes))
+
+def append_to_datacube(cube_path, day, result, files, input_folder, epsg, extent):
+    if result is None:
+        return
+    data, transform = result
+    with stage('write', items=1, nbytes=data.nbytes):
+        write_day(cube_path, day, data, transform, epsg, extent)
+    for file in files:
+        os.remove(os.path.join(input_folder, file))
 
 def browse_destination_folder(self):
     self.destination_folder.set(filedialog.askdirectory())
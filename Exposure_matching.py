@@ -1,37 +1,140 @@
 import argparse
+import numpy as np
 import rasterio
-from skimage import exposure
+from concurrent.futures import as_completed
 import os
 import glob  # Import glob module
+from Common import cached, make_executor
+from Output_profile import DEFAULT_OUTPUT_PROFILE, add_output_profile_argument, profile_meta
+from Profiler import add_profile_argument, profiled, stage
 
-def load_and_match_histograms(source_directory, reference_path, output_directory):
-    # Use glob to find all .tif files in the source directory
-    source_paths = glob.glob(os.path.join(source_directory, '*.tif'))
+# Integer rasters spanning at most this many values are matched through a bincount lookup table
+LUT_MAX_VALUES = 2 ** 24
+# (values, quantiles) of the reference, set once in every worker by init_match_worker
+REFERENCE_CDF = None
 
-    if source_paths and reference_path and output_directory:
-        # Load the reference GeoTIFF
+
+def valid_pixels(image, nodata):
+    valid = np.ones(image.shape, dtype=bool)
+    if np.issubdtype(image.dtype, np.floating):
+        valid &= ~np.isnan(image)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= image != nodata
+    return valid
+
+
+def reference_cdf(image_reference, nodata=None, ignore_nodata=False):
+    """
+    Distinct values of the reference image and their cumulative quantiles, as skimage's
+    match_histograms computes them, optionally leaving out nodata pixels.
+    """
+    values = image_reference.reshape(-1)
+    if ignore_nodata:
+        values = values[valid_pixels(values, nodata)]
+    values, counts = np.unique(values, return_counts=True)
+    return values, np.cumsum(counts) / max(counts.sum(), 1)
+
+
+def load_reference_cdf(reference_path, ignore_nodata, cache_dir):
+    """
+    Return the reference CDF (values, quantiles), cached per (reference file, ignore_nodata) so the
+    reference is only read and sorted once.
+    """
+    def build():
         with rasterio.open(reference_path) as ref:
-            image_reference = ref.read(1)  # Reading the first channel
+            values, quantiles = reference_cdf(ref.read(1), ref.nodata, ignore_nodata)  # Reading the first channel
+        return {'values': values, 'quantiles': quantiles}
+
+    key_parts = (os.path.abspath(reference_path), os.path.getmtime(reference_path), ignore_nodata)
+    cdf = cached(cache_dir, 'reference_cdf', key_parts, build)
+    return cdf['values'], cdf['quantiles']
+
+
+def match_to_cdf(image_source, ref_values, ref_quantiles, valid=None):
+    """
+    Map image_source onto the reference CDF, giving the same values and dtype as
+    skimage.exposure.match_histograms. Pixels outside valid (if given) keep their value and are left
+    out of the source CDF.
+    """
+    source = image_source.reshape(-1) if valid is None else image_source[valid]
+    out_dtype = np.float32 if image_source.dtype in (np.float16, np.float32) else np.float64
+    if source.size == 0:
+        return image_source.astype(out_dtype)
+
+    if source.dtype.kind in 'ui' and int(source.max()) - int(source.min()) < LUT_MAX_VALUES:
+        # A count per integer value is a lookup table, no sort needed
+        lookup = source.astype(np.int64) - int(source.min())
+        counts = np.bincount(lookup)
+    else:
+        _, lookup, counts = np.unique(source, return_inverse=True, return_counts=True)
+    quantiles = np.cumsum(counts) / source.size
+    matched = np.interp(quantiles, ref_quantiles, ref_values)[lookup.reshape(-1)].astype(out_dtype)
+
+    if valid is None:
+        return matched.reshape(image_source.shape)
+    matched_image = image_source.astype(out_dtype)
+    matched_image[valid] = matched
+    return matched_image
 
-            print("Matching Histograms")
 
-        for source_path in source_paths:
-            with rasterio.open(source_path) as src:
-                image_source = src.read(1)  # Reading the first channel
-                meta_source = src.meta
+def match_file(source_path, output_directory, ref_values, ref_quantiles, ignore_nodata=False,
+               output_profile=DEFAULT_OUTPUT_PROFILE):
+    with rasterio.open(source_path) as src:
+        image_source = src.read(1)  # Reading the first channel
+        meta_source = profile_meta(src.meta, output_profile)
+        valid = valid_pixels(image_source, src.nodata) if ignore_nodata else None
 
-                # Apply histogram matching
-                matched_image = exposure.match_histograms(image_source, image_reference)
+    # Apply histogram matching
+    with stage('match', items=1, nbytes=image_source.nbytes):
+        matched_image = match_to_cdf(image_source, ref_values, ref_quantiles, valid)
+
+    # Construct unique output paths
+    base_name = os.path.splitext(os.path.basename(source_path))[0]
+    matched_output_path = os.path.join(output_directory, f"{base_name}_matched.tif")
+
+    # Save the matched images
+    meta_source.update(count=1)  # Ensure metadata is updated for single channel
+    with stage('write', items=1, nbytes=matched_image.nbytes), \
+            rasterio.open(matched_output_path, "w", **meta_source) as dest:
+        dest.write(matched_image, 1)
+
+
+def init_match_worker(ref_values, ref_quantiles):
+    global REFERENCE_CDF
+    REFERENCE_CDF = (ref_values, ref_quantiles)
+
+
+def match_to_reference(source_path, output_directory, ignore_nodata, output_profile):
+    match_file(source_path, output_directory, *REFERENCE_CDF, ignore_nodata, output_profile)
+
+
+def load_and_match_histograms(source_directory, reference_path, output_directory, workers=1, ignore_nodata=False,
+                              cache_dir=None, output_profile=DEFAULT_OUTPUT_PROFILE):
+    # Use glob to find all .tif files in the source directory
+    source_paths = sorted(glob.glob(os.path.join(source_directory, '*.tif')))
+
+    if source_paths and reference_path and output_directory:
+        os.makedirs(output_directory, exist_ok=True)
+        # The reference CDF is computed once and shared by every source file
+        ref_values, ref_quantiles = load_reference_cdf(reference_path, ignore_nodata, cache_dir)
 
-                # Construct unique output paths
-                base_name = os.path.splitext(os.path.basename(source_path))[0]
-                matched_output_path = os.path.join(output_directory, f"{base_name}_matched.tif")
+        print("Matching Histograms")
 
-                # Save the matched images
-                meta_source.update(count=1)  # Ensure metadata is updated for single channel
-                with rasterio.open(matched_output_path, "w", **meta_source) as dest:
-                    dest.write(matched_image, 1)
+        failed = []
+        # The reference CDF goes to each worker once rather than with every file
+        with make_executor(workers, init_match_worker, (ref_values, ref_quantiles)) as executor:
+            futures = {executor.submit(match_to_reference, source_path, output_directory, ignore_nodata,
+                                       output_profile): source_path
+                       for source_path in source_paths}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Failed to match {os.path.basename(futures[future])} due to {e}")
+                    failed.append(futures[future])
 
+        if failed:
+            print(f"Histogram matching failed for {len(failed)} files")
         print("Histogram matching completed for all .tif files in the source directory. Files saved.")
 
 def parse_arguments():
@@ -39,11 +142,21 @@ def parse_arguments():
     parser.add_argument("--source-directory", required=True, help="Path to the directory containing source GeoTIFF files.")
     parser.add_argument("--reference-path", required=True, help="Path to the reference GeoTIFF file.")
     parser.add_argument("--output-directory", required=True, help="Directory to save the processed files.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes matching files in parallel.")
+    parser.add_argument("--ignore-nodata", action="store_true",
+                        help="Leave nodata and NaN pixels out of both histograms and keep them unchanged.")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Folder for the cached reference CDF. Default is '.cdf_cache' in the output directory.")
+    add_output_profile_argument(parser)
+    add_profile_argument(parser)
     return parser.parse_args()
 
 def main():
     args = parse_arguments()
-    load_and_match_histograms(args.source_directory, args.reference_path, args.output_directory)
+    cache_dir = args.cache_dir or os.path.join(args.output_directory, '.cdf_cache')
+    with profiled(args.profile):
+        load_and_match_histograms(args.source_directory, args.reference_path, args.output_directory, args.workers,
+                                  args.ignore_nodata, cache_dir, args.output_profile)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,122 @@
+import json
+import os
+from functools import lru_cache
+
+TILES_SHAPEFILE = 'Data/Black_Marble_IDs/Black_Marble_World_tiles.shp'
+TILE_BOUNDARIES_SHAPEFILE = 'Data/Black_Marble_IDs/BlackMarbleTiles/BlackMarbleTiles.shp'
+COUNTRY_SHAPEFILE = 'Data/World_Countries/World_Countries_Generalized.shp'
+INDEX_PATH = 'Data/geodata_index.json'
+
+
+def read_shapefile(path):
+    # geopandas is only imported once a shapefile is actually needed
+    import geopandas as gpd
+    return gpd.read_file(path)
+
+
+@lru_cache(maxsize=None)
+def country_tile_shapes():
+    """Country parts cut by Black Marble tile, with COUNTRY and TileID columns."""
+    return read_shapefile(TILES_SHAPEFILE)
+
+
+@lru_cache(maxsize=None)
+def tile_boundaries():
+    """Outline of every Black Marble tile, with a TileID column."""
+    return read_shapefile(TILE_BOUNDARIES_SHAPEFILE)
+
+
+@lru_cache(maxsize=None)
+def countries():
+    """Generalized country borders, with a COUNTRY column."""
+    return read_shapefile(COUNTRY_SHAPEFILE)
+
+
+def country_shape(country):
+    shapes = countries()
+    return shapes[shapes['COUNTRY'] == country]
+
+
+def source_mtimes():
+    return {path: os.path.getmtime(path) for path in (TILES_SHAPEFILE, TILE_BOUNDARIES_SHAPEFILE)}
+
+
+def build_index():
+    """
+    Summarise the tile shapefiles as plain bounds: every tile's outline, and for every country its
+    overall bounds and the bounds of its part in each tile it touches.
+    """
+    tiles = country_tile_shapes()
+    boundaries = tile_boundaries()
+    index = {
+        'sources': source_mtimes(),
+        'epsg': tiles.crs.to_epsg(),
+        'tiles': {tile_id: [float(v) for v in rows.total_bounds] for tile_id, rows in boundaries.groupby('TileID')},
+        'countries': {},
+    }
+    for country, rows in tiles.groupby('COUNTRY', sort=False):
+        index['countries'][country] = {
+            'bounds': [float(v) for v in rows.total_bounds],
+            # Tiles are kept in the order they appear in the shapefile
+            'tiles': {tile_id: [float(v) for v in parts.total_bounds]
+                      for tile_id, parts in rows.groupby('TileID', sort=False)},
+        }
+    return index
+
+
+@lru_cache(maxsize=None)
+def geodata_index():
+    """
+    Return the country and tile index, read from INDEX_PATH and rebuilt from the shapefiles when they
+    have changed since it was written.
+    """
+    if os.path.exists(INDEX_PATH):
+        with open(INDEX_PATH) as f:
+            index = json.load(f)
+        if index.get('sources') == source_mtimes():
+            return index
+
+    index = build_index()
+    # Written under a per-process name and moved into place, so a script starting at the same time
+    # never reads a half-written index
+    tmp_path = f"{INDEX_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, INDEX_PATH)
+    except OSError as e:
+        print(f"Could not save the geodata index to {INDEX_PATH} due to {e}")
+    return index
+
+
+def country_entry(country):
+    entry = geodata_index()['countries'].get(country.strip())
+    if entry is None:
+        raise ValueError(f"No shape data found for the selected country: {country}")
+    return entry
+
+
+def country_bounds(country):
+    """(west, south, east, north) of the country."""
+    return tuple(country_entry(country)['bounds'])
+
+
+def country_tiles(country):
+    """
+    Return ({tile_id: tile bounds} for every tile the country touches, epsg of the tile grid).
+    """
+    tiles = geodata_index()['tiles']
+    tile_bounds = {tile_id: tuple(tiles.get(tile_id, [float('nan')] * 4)) for tile_id in country_entry(country)['tiles']}
+    return tile_bounds, geodata_index()['epsg']
+
+
+def country_windows(country, tile_bounds):
+    """
+    Return {tile_id: bounds} of the part of each tile covered by the country.
+    """
+    parts = country_entry(country)['tiles']
+    read_bounds = {}
+    for tile_id, (left, bottom, right, top) in tile_bounds.items():
+        west, south, east, north = parts[tile_id]
+        read_bounds[tile_id] = (max(west, left), max(south, bottom), min(east, right), min(north, top))
+    return read_bounds
@@ -0,0 +1,46 @@
+import numpy as np
+
+# plain: GDAL's default striped, uncompressed GeoTIFF
+# tiled: internally tiled, deflate compressed GeoTIFF with a predictor
+# cog: Cloud Optimized GeoTIFF, tiled and compressed like 'tiled' with internal overviews
+OUTPUT_PROFILES = ['plain', 'tiled', 'cog']
+DEFAULT_OUTPUT_PROFILE = 'tiled'
+# Matches the default --block-rows of Stacker.py, so row blocks cover whole tiles
+BLOCK_SIZE = 512
+
+
+def creation_options(output_profile, dtype):
+    """
+    rasterio.open keyword arguments (driver and creation options) for writing a band of dtype.
+    """
+    if output_profile == 'plain':
+        return {'driver': 'GTiff'}
+    # Horizontal differencing for integers, the floating point predictor for floats
+    predictor = 3 if np.dtype(dtype).kind == 'f' else 2
+    if output_profile == 'tiled':
+        return {'driver': 'GTiff', 'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE,
+                'compress': 'deflate', 'predictor': predictor}
+    if output_profile == 'cog':
+        # The COG driver builds the overviews itself when the file is closed
+        return {'driver': 'COG', 'blocksize': BLOCK_SIZE, 'compress': 'deflate', 'predictor': 'YES',
+                'overview_resampling': 'average'}
+    raise ValueError(f"Unknown output profile: {output_profile}")
+
+
+def profile_meta(meta, output_profile=DEFAULT_OUTPUT_PROFILE):
+    """
+    Copy of a rasterio meta/profile dict set up to write with output_profile. Block and compression
+    settings inherited from the source are dropped so the profile decides them.
+    """
+    meta = {key: value for key, value in meta.items()
+            if key not in ('driver', 'tiled', 'blockxsize', 'blockysize', 'blocksize', 'compress', 'predictor',
+                           'interleave', 'photometric')}
+    meta.update(creation_options(output_profile, meta['dtype']))
+    return meta
+
+
+def add_output_profile_argument(parser):
+    parser.add_argument("--output-profile", default=DEFAULT_OUTPUT_PROFILE, choices=OUTPUT_PROFILES,
+                        help="GeoTIFF layout of written rasters: 'plain' striped and uncompressed, 'tiled' tiled "
+                             "and deflate compressed, or 'cog' tiled, compressed and with overviews. "
+                             f"Default is {DEFAULT_OUTPUT_PROFILE}.")
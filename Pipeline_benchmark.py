@@ -0,0 +1,307 @@
+import argparse
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from Geodata import TILE_BOUNDARIES_SHAPEFILE, TILES_SHAPEFILE, country_bounds, country_tiles
+
+STAGES = ['convert', 'crop', 'match', 'stack', 'bin']
+NTL_PATH = "/HDFEOS/GRIDS/VIIRS_Grid_DNB_2d/Data Fields/Gap_Filled_DNB_BRDF-Corrected_NTL"
+# VNP46A2 marks missing pixels with this value
+FILL_VALUE = 65535
+FIRST_DAY = datetime.date(2022, 1, 1)
+
+
+def synthetic_ntl(rng, shape):
+    # Mostly dim pixels with a long bright tail, and a few fill pixels as in real granules
+    data = np.minimum(rng.lognormal(mean=2.0, sigma=1.2, size=shape) * 10, FILL_VALUE - 1).astype('uint16')
+    data[rng.random(shape) < 0.01] = FILL_VALUE
+    return data
+
+
+def day_names(days):
+    return [(FIRST_DAY + datetime.timedelta(days=i)).strftime('%Y%j') for i in range(days)]
+
+
+def country_grid(country, tile_size):
+    """
+    Transform and shape of a daily GeoTIFF covering the country on the tile pixel grid, as
+    Downloader.py --country-window writes it.
+    """
+    # Tiles sit on a 10 degree grid, so any of them gives the pixel grid
+    left, _, _, top = next(iter(country_tiles(country)[0].values()))
+    res = 10 / tile_size
+    west, south, east, north = country_bounds(country)
+    col_start, col_stop = int(np.floor((west - left) / res)), int(np.ceil((east - left) / res))
+    row_start, row_stop = int(np.floor((top - north) / res)), int(np.ceil((top - south) / res))
+    transform = from_origin(left + col_start * res, top - row_start * res, res, res)
+    return transform, (row_stop - row_start, col_stop - col_start)
+
+
+def make_fixtures(fixture_dir, country, days, tile_size, seed=0):
+    """
+    Write synthetic VNP46A2 granules (h5/) and daily GeoTIFFs (daily/) for the country, unless a
+    previous run already made them with the same settings.
+    """
+    done_path = os.path.join(fixture_dir, 'fixtures.json')
+    settings = {'country': country, 'days': days, 'tile_size': tile_size, 'seed': seed}
+    if os.path.exists(done_path):
+        with open(done_path) as f:
+            if json.load(f) == settings:
+                return
+    shutil.rmtree(fixture_dir, ignore_errors=True)
+    os.makedirs(os.path.join(fixture_dir, 'h5'))
+    os.makedirs(os.path.join(fixture_dir, 'daily'))
+
+    rng = np.random.default_rng(seed)
+    tile_bounds, epsg = country_tiles(country)
+    transform, shape = country_grid(country, tile_size)
+    for day in day_names(days):
+        for tile_id in tile_bounds:
+            path = os.path.join(fixture_dir, 'h5', f"VNP46A2.A{day}.{tile_id}.001.h5")
+            with h5py.File(path, 'w') as f:
+                f.create_dataset(NTL_PATH, data=synthetic_ntl(rng, (tile_size, tile_size)),
+                                 chunks=(min(tile_size, 480), min(tile_size, 480)), compression='gzip')
+        with rasterio.open(os.path.join(fixture_dir, 'daily', f"{country}_{day}.tif"), 'w', driver='GTiff',
+                           height=shape[0], width=shape[1], count=1, dtype='uint16', crs=f'EPSG:{epsg}',
+                           transform=transform) as dst:
+            dst.write(synthetic_ntl(rng, shape), 1)
+
+    with open(done_path, 'w') as f:
+        json.dump(settings, f)
+    print(f"Fixtures for {country}: {days} days, {len(tile_bounds)} tiles of {tile_size}x{tile_size} pixels")
+
+
+def run_convert(inputs, output_dir, country, workers):
+    from Downloader import process_h5_files
+    process_h5_files(TILES_SHAPEFILE, TILE_BOUNDARIES_SHAPEFILE, country, inputs, output_dir, workers)
+    return len(glob.glob(os.path.join(output_dir, '*.tif')))
+
+
+def run_crop(inputs, output_dir, country, workers):
+    from Country_cropper import run
+    run(inputs, output_dir, country, False, workers, os.path.join(output_dir, '.mask_cache'))
+    return len(glob.glob(os.path.join(inputs, '*.tif')))
+
+
+def run_match(inputs, output_dir, country, workers):
+    from Exposure_matching import load_and_match_histograms
+    paths = sorted(glob.glob(os.path.join(inputs, '*.tif')))
+    load_and_match_histograms(inputs, paths[0], output_dir, workers)
+    return len(paths)
+
+
+def run_stack(inputs, output_dir, country, workers):
+    from Stacker import parse_arguments, process_tif_files
+    # Stacker writes the composites next to its inputs, so it stacks links to the days from the output folder
+    paths = sorted(glob.glob(os.path.join(inputs, '*.tif')))
+    for path in paths:
+        os.symlink(os.path.abspath(path), os.path.join(output_dir, os.path.basename(path)))
+    process_tif_files(parse_arguments(['--folder-path', output_dir, '--threshold-value', '5000', '--monthly-stacking',
+                                       '--mean-stacking', '--sigma-stacking', '--sigma-value', '2',
+                                       '--threads', str(workers)]))
+    return len(paths)
+
+
+def run_bin(inputs, output_dir, country, workers):
+    from Binner import process_raster_data
+    paths = sorted(glob.glob(os.path.join(inputs, '*.tif')))
+    process_raster_data(country, paths, None, output_dir, 10, os.path.join(output_dir, '.zone_cache'),
+                        workers=workers)
+    return len(paths)
+
+
+STAGE_FUNCTIONS = {'convert': run_convert, 'crop': run_crop, 'match': run_match, 'stack': run_stack,
+                   'bin': run_bin}
+
+
+def process_io():
+    # Bytes passed through read and write calls, Linux only
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def measure_stage(stage, inputs, output_dir, country, workers):
+    """
+    Run one stage and return its metrics. Runs in a fresh process, so peak RSS belongs to this stage.
+    """
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    read_before, written_before = process_io()
+    start = time.perf_counter()
+    items = STAGE_FUNCTIONS[stage](inputs, output_dir, country, workers)
+    seconds = time.perf_counter() - start
+    read_after, written_after = process_io()
+    # ru_maxrss is in kilobytes on Linux; worker processes count through RUSAGE_CHILDREN
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    return {
+        'seconds': seconds,
+        'items': items,
+        'peak_rss': peak_rss,
+        'read_bytes': None if read_before is None else read_after - read_before,
+        'write_bytes': None if written_before is None else written_after - written_before,
+    }
+
+
+def run_stage(stage, fixture_dir, country, workers, repeat):
+    """
+    Run a stage repeat times, each in a new process on a fresh copy of its inputs, and keep the
+    fastest run.
+    """
+    best = None
+    for _ in range(repeat):
+        work_dir = tempfile.mkdtemp(prefix=f'benchmark_{stage}_')
+        try:
+            if stage == 'convert':
+                # Conversion deletes the granules it has merged
+                inputs = shutil.copytree(os.path.join(fixture_dir, 'h5'), os.path.join(work_dir, 'h5'))
+            else:
+                inputs = os.path.join(fixture_dir, 'daily')
+            output_dir = os.path.join(work_dir, 'output')
+            os.makedirs(output_dir)
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                metrics = executor.submit(measure_stage, stage, inputs, output_dir, country, workers).result()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if best is None or metrics['seconds'] < best['seconds']:
+            best = metrics
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(history_path):
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path) as f:
+        return json.load(f)
+
+
+def save_history(history_path, history):
+    with open(history_path, 'w') as f:
+        json.dump(history, f, indent=2)
+
+
+def format_bytes(value):
+    return 'n/a' if value is None else f"{value / 2 ** 20:.1f} MB"
+
+
+def run_benchmark(country, days, tile_size, stages, workers, repeat, fixture_dir, history_path, label=None):
+    make_fixtures(fixture_dir, country, days, tile_size)
+    run = {
+        'label': label,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'settings': {'country': country, 'days': days, 'tile_size': tile_size, 'workers': workers, 'repeat': repeat},
+        'stages': {},
+    }
+    for stage in stages:
+        try:
+            metrics = run_stage(stage, fixture_dir, country, workers, repeat)
+        except Exception as e:
+            print(f"Failed to benchmark {stage} due to {e}")
+            continue
+        run['stages'][stage] = metrics
+        print(f"{stage}: {metrics['seconds']:.2f}s for {metrics['items']} items, peak RSS "
+              f"{format_bytes(metrics['peak_rss'])}, read {format_bytes(metrics['read_bytes'])}, "
+              f"written {format_bytes(metrics['write_bytes'])}")
+
+    history = load_history(history_path)
+    history.append(run)
+    save_history(history_path, history)
+    print(f"Run {len(history) - 1} saved to {history_path}")
+
+
+def find_run(history, key):
+    """A run by label, or by its position in the history (negative counts from the end)."""
+    for run in reversed(history):
+        if run.get('label') == key:
+            return run
+    try:
+        return history[int(key)]
+    except (ValueError, IndexError):
+        raise ValueError(f"No run {key} in the benchmark history")
+
+
+def compare_runs(history_path, base_key, new_key, tolerance):
+    """
+    Print the change of every stage between two runs and return the stages that got slower or
+    bigger by more than tolerance.
+    """
+    history = load_history(history_path)
+    base, new = find_run(history, base_key), find_run(history, new_key)
+    if base['settings'] != new['settings']:
+        print(f"⚠️ The runs used different settings: {base['settings']} and {new['settings']}")
+
+    regressions = []
+    print(f"{'stage':<8} {'base':>9} {'new':>9} {'time':>8} {'peak RSS':>9}")
+    for stage in STAGES:
+        if stage not in base['stages'] or stage not in new['stages']:
+            continue
+        before, after = base['stages'][stage], new['stages'][stage]
+        time_change = after['seconds'] / before['seconds'] - 1
+        rss_change = after['peak_rss'] / before['peak_rss'] - 1
+        regressed = time_change > tolerance or rss_change > tolerance
+        if regressed:
+            regressions.append(stage)
+        print(f"{stage:<8} {before['seconds']:>8.2f}s {after['seconds']:>8.2f}s {time_change:>+8.1%} "
+              f"{rss_change:>+9.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the processing stages on synthetic VNP46A2 data, offline.")
+    parser.add_argument("--country", default="United Arab Emirates",
+                        help="Country whose tiles and bounds the synthetic data covers.")
+    parser.add_argument("--days", type=int, default=7, help="Number of synthetic days.")
+    parser.add_argument("--tile-size", type=int, default=2400,
+                        help="Width and height of the synthetic granules. Real VNP46A2 tiles are 2400.")
+    parser.add_argument("--stages", nargs='+', default=STAGES, choices=STAGES, help="Stages to run. Default is all.")
+    parser.add_argument("--workers", type=int, default=1, help="Workers passed to every stage.")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs per stage, the fastest one is kept.")
+    parser.add_argument("--fixture-dir", default='.benchmark_fixtures',
+                        help="Folder for the synthetic data, reused while the settings are unchanged.")
+    parser.add_argument("--history", default='benchmark_history.json', help="JSON file the runs are appended to.")
+    parser.add_argument("--label", default=None, help="Name for this run, to refer to it with --compare.")
+    parser.add_argument("--compare", nargs=2, metavar=('BASE', 'NEW'), default=None,
+                        help="Compare two runs from the history, by label or index such as -2 -1, instead of running.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative increase of time or peak RSS reported as a regression. Default is 0.1.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.compare:
+        regressions = compare_runs(args.history, *args.compare, args.tolerance)
+        if regressions:
+            raise SystemExit(f"Regressions in: {', '.join(regressions)}")
+        print("No regressions.")
+        return
+    run_benchmark(args.country, args.days, args.tile_size, args.stages, args.workers, args.repeat, args.fixture_dir,
+                  args.history, args.label)
+
+
+if __name__ == "__main__":
+    main()
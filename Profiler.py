@@ -0,0 +1,219 @@
+import contextlib
+import csv
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# Set in every process of a profiled run, worker processes included, to the folder their records go to
+PROFILE_ENV = 'NTL_PROFILE_DIR'
+# Seconds between resident memory samples while a stage is running
+SAMPLE_INTERVAL = 0.02
+RECORD_FIELDS = ['stage', 'pid', 'start', 'seconds', 'items', 'bytes', 'peak_rss', 'failed']
+
+_records_dir = os.environ.get(PROFILE_ENV)
+_lock = threading.Lock()
+_active = set()
+_sampler_pid = None
+
+
+def reset_after_fork():
+    # A process forked while another thread held the lock would otherwise never get it back
+    global _lock, _active
+    _lock = threading.Lock()
+    _active = set()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def current_rss():
+    # Resident memory in bytes, None where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def sample_memory():
+    while True:
+        rss = current_rss()
+        with _lock:
+            for running in _active:
+                running.peak_rss = max(running.peak_rss, rss)
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def start_sampler():
+    global _sampler_pid
+    with _lock:
+        # Forked worker processes inherit the pid of the parent's sampler but not its thread
+        if _sampler_pid == os.getpid():
+            return
+        _sampler_pid = os.getpid()
+    threading.Thread(target=sample_memory, daemon=True).start()
+
+
+class Stage:
+    """
+    Times a block of work and records it on exit with its item and byte counts and the peak
+    resident memory of the process while it ran.
+    """
+
+    def __init__(self, name, items=0, nbytes=0):
+        self.name = name
+        self.items = items
+        self.nbytes = nbytes
+
+    def add(self, items=0, nbytes=0):
+        self.items += items
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        rss = current_rss()
+        if rss is not None:
+            start_sampler()
+        self.peak_rss = rss
+        self.start = time.time()
+        self.started = time.perf_counter()
+        with _lock:
+            _active.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.started
+        with _lock:
+            _active.discard(self)
+        rss = current_rss()
+        record = {
+            'stage': self.name,
+            'pid': os.getpid(),
+            'start': self.start,
+            'seconds': seconds,
+            'items': self.items,
+            'bytes': self.nbytes,
+            'peak_rss': None if rss is None else max(self.peak_rss, rss),
+            'failed': exc_type is not None,
+        }
+        # Each process appends to its own file, one whole line per write, so this needs no lock
+        with open(os.path.join(_records_dir, f'{os.getpid()}.jsonl'), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        return False
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def add(self, items=0, nbytes=0):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(name, items=0, nbytes=0):
+    """
+    Context manager recording the stage when profiling is enabled, and a shared no-op otherwise.
+    """
+    if _records_dir is None:
+        return NULL_STAGE
+    return Stage(name, items, nbytes)
+
+
+def enable():
+    global _records_dir
+    _records_dir = tempfile.mkdtemp(prefix='ntl_profile_')
+    # Spawned worker processes pick this up when they import the module
+    os.environ[PROFILE_ENV] = _records_dir
+
+
+def disable():
+    global _records_dir
+    if _records_dir:
+        shutil.rmtree(_records_dir, ignore_errors=True)
+    os.environ.pop(PROFILE_ENV, None)
+    _records_dir = None
+
+
+def read_records():
+    records = []
+    for path in glob.glob(os.path.join(_records_dir, '*.jsonl')):
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return sorted(records, key=lambda record: record['start'])
+
+
+def summarize(records):
+    """
+    Totals per stage, in the order the stages first ran. Seconds are summed over calls, so stages
+    that ran in parallel can add up to more than the wall time.
+    """
+    summary = {}
+    for record in records:
+        total = summary.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'items': 0, 'bytes': 0,
+                                                     'peak_rss': None, 'failed': 0})
+        total['calls'] += 1
+        total['seconds'] += record['seconds']
+        total['items'] += record['items']
+        total['bytes'] += record['bytes']
+        if record['peak_rss'] is not None:
+            total['peak_rss'] = max(total['peak_rss'] or 0, record['peak_rss'])
+        total['failed'] += record['failed']
+    return summary
+
+
+def write_report(report_path, wall_seconds):
+    records = read_records()
+    summary = summarize(records)
+    if report_path.lower().endswith('.csv'):
+        with open(report_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(report_path, 'w') as f:
+            json.dump({'command': sys.argv, 'seconds': wall_seconds, 'summary': summary, 'records': records}, f,
+                      indent=2)
+
+    print(f"{'stage':<12} {'calls':>6} {'seconds':>9} {'items':>7} {'MB':>9} {'peak MB':>8}")
+    for name, total in summary.items():
+        peak = 'n/a' if total['peak_rss'] is None else f"{total['peak_rss'] / 2 ** 20:.0f}"
+        print(f"{name:<12} {total['calls']:>6} {total['seconds']:>9.2f} {total['items']:>7} "
+              f"{total['bytes'] / 2 ** 20:>9.1f} {peak:>8}")
+    print(f"Profile of {wall_seconds:.1f}s saved to {report_path}")
+
+
+@contextlib.contextmanager
+def profiled(report_path):
+    """
+    Profile the stages run inside the block and write the report to report_path. Does nothing when
+    report_path is None.
+    """
+    if not report_path:
+        yield
+        return
+    enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        try:
+            write_report(report_path, time.perf_counter() - start)
+        finally:
+            disable()
+
+
+def add_profile_argument(parser):
+    parser.add_argument("--profile", default=None, metavar="REPORT",
+                        help="Record the time, item count, bytes and peak memory of every processing stage and write "
+                             "them to REPORT, as CSV if it ends in .csv and JSON otherwise.")
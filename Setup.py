@@ -22,8 +22,8 @@ def main(libraries):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Install Python libraries using pip.")
     parser.add_argument('libraries', nargs='*', default=[
-        "geopandas", "matplotlib", "numpy", "pandas", "rasterio", "rasterstats",
-        "shapely", "h5py", "requests", "scikit-image", "astropy"
+        "geopandas", "matplotlib", "numpy", "pandas", "rasterio",
+        "shapely", "h5py", "requests", "astropy", "pyarrow"
     ], help="The names of the libraries to install. If none are provided, a default set of libraries will be installed.")
 
     args = parser.parse_args()
@@ -1,14 +1,24 @@
 import argparse
+import contextlib
+import json
 import os
 import glob
+import h5py
 import rasterio
 import numpy as np
-from datetime import datetime
-from astropy.stats import SigmaClip
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import matplotlib.pyplot as plt
+from rasterio.windows import Window
+from Datacube import cube_days, cube_grid, read_days
+from Output_profile import DEFAULT_OUTPUT_PROFILE, add_output_profile_argument, profile_meta
+from Profiler import add_profile_argument, profiled, stage
 
+PLOT_MAX_PIXELS = 1024
+CLIP_CHUNK_PIXELS = 16384
 
-def parse_arguments():
+
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser(
         description="Process and stack .tif files by month, with options to delete the originals.")
     parser.add_argument("--folder-path", required=True, help="Path to the folder containing .tif files.")
@@ -22,7 +32,24 @@ def parse_arguments():
     parser.add_argument("--monthly-stacking", action='store_true', help="Stack rasters monthly based on their dates.")
     parser.add_argument("--delete-originals", action='store_true',
                         help="Delete original raster files after processing.")
-    return parser.parse_args()
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of threads used for sigma clipping each block. Default is 1.")
+    parser.add_argument("--block-rows", type=int, default=512,
+                        help="Number of raster rows stacked at a time. Lower values use less memory, multiples of "
+                             "512 line up with the tiles of tiled rasters. Default is 512.")
+    parser.add_argument("--incremental", action='store_true',
+                        help="Fold new rasters into per-month running sums and update the monthly mean and "
+                             "standard deviation without rereading earlier days.")
+    parser.add_argument("--rolling-days", type=int, nargs='+', default=[],
+                        help="Window lengths in days for rolling mean composites, e.g. --rolling-days 7 30.")
+    parser.add_argument("--datacube", default=None,
+                        help="Stack months from this HDF5 datacube (see Downloader.py --datacube) instead of the "
+                             ".tif files in --folder-path. Outputs are still written to --folder-path.")
+    parser.add_argument("--first-day", default=None, help="With --datacube, the first day to stack as YYYYDDD.")
+    parser.add_argument("--last-day", default=None, help="With --datacube, the last day to stack as YYYYDDD.")
+    add_output_profile_argument(parser)
+    add_profile_argument(parser)
+    return parser.parse_args(argv)
 
 
 def julian_to_month(julian_day):
@@ -35,75 +62,442 @@ def delete_original_files(files):
         print(f"Deleted file: {file}")
 
 
-def stack_and_save(data_arrays, month, folder_path, meta, mean_stacking, sigma_stacking, maxiters, sigma_value):
+def walk_sorted(flat, width, columns, position, limit, step, passes):
+    # Move each column's position through its sorted values by step until passes(values, subset) is False
+    # or the limit is reached. Clipping moves the ends by a value or two, so this beats a binary search.
+    position = position.copy()
+    moving = np.flatnonzero(position != limit)
+    while moving.size:
+        index = position[moving] if step > 0 else position[moving] - 1
+        moving = moving[passes(flat[index * width + columns[moving]], moving)]
+        position[moving] += step
+        moving = moving[position[moving] != limit[moving]]
+    return position
+
+
+def clipped_mean(pixels, sigma, maxiters):
+    """
+    Iteratively sigma clip each column of a (days, pixels) array and return the mean of what survives.
+    Once a column is sorted (NaN last), clipping only removes its lowest and highest values, so the
+    surviving values are always a slice [lo, hi). Running sums give each slice's mean and spread,
+    and the slice ends only move by the number of values clipped.
+    """
+    days, width = pixels.shape
+    values = np.ascontiguousarray(np.sort(pixels.T, axis=1).T)
+    flat = values.ravel()
+    columns = np.arange(width)
+    lo = np.zeros(width, dtype=np.intp)
+    hi = np.isfinite(values).sum(axis=0)
+
+    # Centring columns on a typical value keeps the running sums well conditioned. Sums past a
+    # column's last valid value turn NaN, but only positions up to hi are ever looked up.
+    offset = np.where(hi > 0, flat[np.maximum(hi - 1, 0) // 2 * width + columns], 0).astype(np.float64)
+    sums = np.zeros((days + 1, width))
+    squares = np.zeros((days + 1, width))
+    for day in range(days):
+        shifted = values[day] - offset
+        np.add(sums[day], shifted, out=sums[day + 1])
+        np.add(squares[day], shifted * shifted, out=squares[day + 1])
+    sums, squares = sums.ravel(), squares.ravel()
+
+    valid = hi.copy()
+    low = np.full(width, -np.inf)
+    high = np.full(width, np.inf)
+    active = np.flatnonzero(hi > 0)
+    iteration = 0
+    while active.size and (maxiters is None or iteration < maxiters):
+        start, stop = lo[active], hi[active]
+        count = stop - start
+        center = (flat[(start + (count - 1) // 2) * width + active].astype(np.float64) +
+                  flat[(start + count // 2) * width + active]) / 2
+        mean = (sums[stop * width + active] - sums[start * width + active]) / count
+        variance = (squares[stop * width + active] - squares[start * width + active]) / count - mean * mean
+        spread = sigma * np.sqrt(np.maximum(variance, 0))
+        low[active], high[active] = center - spread, center + spread
+        active_low, active_high = low[active], high[active]
+        new_start = walk_sorted(flat, width, active, start, stop, 1, lambda v, m: v < active_low[m])
+        new_stop = walk_sorted(flat, width, active, stop, new_start, -1, lambda v, m: v > active_high[m])
+        lo[active], hi[active] = new_start, new_stop
+        iteration += 1
+
+        # Like astropy, a column clipped to nothing gets NaN bounds on its next iteration, which keep everything
+        emptied = new_stop <= new_start
+        if maxiters is None or iteration < maxiters:
+            low[active[emptied]], high[active[emptied]] = -np.inf, np.inf
+        # Pixels with nothing clipped have converged and drop out of later iterations
+        active = active[((new_start != start) | (new_stop != stop)) & ~emptied]
+
+    # astropy masks the original data with the final bounds, which can bring back values clipped earlier
+    lo = walk_sorted(flat, width, columns, lo, np.zeros(width, dtype=np.intp), -1, lambda v, m: v >= low[m])
+    hi = walk_sorted(flat, width, columns, hi, valid, 1, lambda v, m: v <= high[m])
+    count = hi - lo
+    mean = np.full(width, np.nan)
+    np.divide(sums[hi * width + columns] - sums[lo * width + columns], count, out=mean, where=count > 0)
+    return mean + offset
+
+
+def sigma_clip_mean(block, sigma, maxiters=5, threads=1):
+    """
+    Sigma-clipped mean of a (days, rows, cols) stack with NaN for missing values. Each pixel is clipped
+    around its median by sigma standard deviations until nothing changes or maxiters is reached, which
+    is what astropy's SigmaClip does along axis 0, but without building masked arrays over the cube.
+    """
+    pixels = block.reshape(block.shape[0], -1)
+    # Working on cache-sized chunks of pixels is faster even on one thread
+    chunks = [pixels[:, start:start + CLIP_CHUNK_PIXELS] for start in range(0, pixels.shape[1], CLIP_CHUNK_PIXELS)]
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        means = list(executor.map(lambda chunk: clipped_mean(chunk, sigma, maxiters), chunks))
+    return np.concatenate(means).reshape(block.shape[1:])
+
+
+def stack_and_save(data_arrays, month, folder_path, meta, mean_stacking, sigma_stacking, maxiters, sigma_value,
+                   block_rows=None, threads=1):
     if not data_arrays:
         print("No data arrays available for stacking.")
         return
 
-    stacked_arrays = np.stack(data_arrays, axis=0)
-    fig, axs = plt.subplots(1, 2 if mean_stacking and sigma_stacking else 1, figsize=(10, 5))
+    def read_block(row_off, nrows):
+        return np.stack([data[row_off:row_off + nrows] for data in data_arrays], axis=0)
+
+    height = data_arrays[0].shape[0]
+    stack_blocks(read_block, height, month, folder_path, meta, mean_stacking, sigma_stacking, maxiters, sigma_value,
+                 block_rows or height, threads)
+
+
+def stack_blocks(read_block, height, month, folder_path, meta, mean_stacking, sigma_stacking, maxiters, sigma_value,
+                 block_rows=512, threads=1):
+    """
+    Stack a month in blocks of rows. read_block(row_off, nrows) returns a (days, nrows, width) float32
+    array with NaN for missing values. Every output pixel only depends on its own column of the stack,
+    so the results are the same as stacking the whole month at once.
+    """
+    mean_path = os.path.join(folder_path, f'output_mean_{month}.tif')
+    sigma_path = os.path.join(folder_path, f'output_sigma_clipped_{month}.tif')
+
+    with contextlib.ExitStack() as stack:
+        mean_dst = stack.enter_context(rasterio.open(mean_path, 'w', **meta)) if mean_stacking else None
+        sigma_dst = stack.enter_context(rasterio.open(sigma_path, 'w', **meta)) if sigma_stacking else None
+
+        for row_off in range(0, height, block_rows):
+            nrows = min(block_rows, height - row_off)
+            with stage('stack', items=1) as stacking:
+                block = read_block(row_off, nrows)
+                stacking.add(nbytes=block.nbytes)
+                mean = np.nanmean(block, axis=0) if mean_dst else None
+                clipped = sigma_clip_mean(block, sigma_value, maxiters, threads) if sigma_dst else None
+            window = Window(0, row_off, block.shape[2], nrows)
+            with stage('write', items=1, nbytes=block.nbytes // block.shape[0]):
+                if mean_dst:
+                    mean_dst.write(mean, 1, window=window)
+                if sigma_dst:
+                    sigma_dst.write(clipped, 1, window=window)
+
+    with stage('plot', items=1):
+        plot_stacks(month, folder_path, mean_path if mean_stacking else None, sigma_path if sigma_stacking else None)
+
+
+def read_for_plot(path):
+    # A decimated read keeps plotting memory independent of the raster size
+    with rasterio.open(path) as src:
+        scale = max(1, int(np.ceil(max(src.height, src.width) / PLOT_MAX_PIXELS)))
+        return src.read(1, out_shape=(src.height // scale or 1, src.width // scale or 1))
+
+
+def plot_stacks(month, folder_path, mean_path, sigma_path):
+    fig, axs = plt.subplots(1, 2 if mean_path and sigma_path else 1, figsize=(10, 5))
     if not isinstance(axs, np.ndarray):
         axs = [axs]
     plot_idx = 0
 
-    if mean_stacking:
-        mean_array = np.nanmean(stacked_arrays, axis=0)
-        output_path = os.path.join(folder_path, f'output_mean_{month}.tif')
-        with rasterio.open(output_path, 'w', **meta) as dst:
-            dst.write(mean_array, 1)
-        axs[plot_idx].imshow(np.log1p(mean_array), cmap='turbo')
+    if mean_path:
+        axs[plot_idx].imshow(np.log1p(read_for_plot(mean_path)), cmap='turbo')
         axs[plot_idx].set_title(f'Log of Mean Stack {month}')
         plot_idx += 1
 
-    if sigma_stacking:
-        sigma_clip = SigmaClip(sigma=sigma_value, maxiters=maxiters)
-        clipped_arrays = sigma_clip(stacked_arrays, axis=0)
-        mean_array_clipped = np.nanmean(clipped_arrays, axis=0)
-        output_path = os.path.join(folder_path, f'output_sigma_clipped_{month}.tif')
-        with rasterio.open(output_path, 'w', **meta) as dst:
-            dst.write(mean_array_clipped, 1)
-        axs[plot_idx].imshow(np.log1p(mean_array_clipped), cmap='turbo')
+    if sigma_path:
+        axs[plot_idx].imshow(np.log1p(read_for_plot(sigma_path)), cmap='turbo')
         axs[plot_idx].set_title(f'Log of Sigma Clipped {month}')
 
     plt.tight_layout()
     plt.savefig(os.path.join(folder_path, f'output_plot_{month}.pdf'))
+    plt.close(fig)
+
+
+def file_block_reader(datasets, threshold_value):
+    def read_block(row_off, nrows):
+        window = Window(0, row_off, datasets[0].width, nrows)
+        block = np.empty((len(datasets), nrows, datasets[0].width), dtype='float32')
+        for i, src in enumerate(datasets):
+            block[i] = src.read(1, window=window)
+        block[block > threshold_value] = np.nan
+        return block
+    return read_block
+
+
+
+def cube_block_reader(cube, indices, threshold_value):
+    def read_block(row_off, nrows):
+        # One read per block, covering whole chunks of every day in the month
+        block = read_days(cube, indices, slice(row_off, row_off + nrows)).astype('float32')
+        block[block > threshold_value] = np.nan
+        return block
+    return read_block
+
+
+def stack_datacube(cube_path, folder_path, threshold_value, mean_stacking, sigma_stacking, maxiters, sigma_value,
+                   block_rows=512, threads=1, output_profile=DEFAULT_OUTPUT_PROFILE, first_day=None, last_day=None):
+    """
+    Stack every month of a datacube, grouping days by the cube's day coordinates rather than file names.
+    """
+    with h5py.File(cube_path, 'r') as cube:
+        grid = cube_grid(cube)
+        meta = output_meta(grid, output_profile)
+        months = {}
+        for day, index in cube_days(cube, first_day, last_day):
+            months.setdefault(julian_to_month(day), []).append(index)
+        for month, indices in sorted(months.items()):
+            stack_blocks(cube_block_reader(cube, indices, threshold_value), grid['height'], month, folder_path, meta,
+                         mean_stacking, sigma_stacking, maxiters, sigma_value, block_rows, threads)
+
+
+def parse_date_part(base_name):
+    return base_name.split('_')[1][:7]  # Assuming format 'Country_YYYYDDD'
+
+
+def group_files_by_month(file_list):
+    grouped_files = {}
+    for file in file_list:
+        base_name = os.path.basename(file)
+        try:
+            month_key = julian_to_month(parse_date_part(base_name))
+            if month_key not in grouped_files:
+                grouped_files[month_key] = []
+            grouped_files[month_key].append(file)
+        except (ValueError, IndexError) as e:
+            print(f"Skipping file {base_name} due to error: {e}")
+    return grouped_files
+
+
+def read_thresholded(src, threshold_value):
+    data = src.read(1).astype('float32')  # Read first band
+    data[data > threshold_value] = np.nan
+    return data
+
 
+def grid_of(src):
+    return {'crs': src.crs.to_wkt() if src.crs else None, 'transform': list(src.transform)[:6],
+            'height': src.height, 'width': src.width, 'dtype': src.dtypes[0], 'nodata': src.nodata}
+
+
+def output_meta(grid, output_profile=DEFAULT_OUTPUT_PROFILE):
+    return profile_meta({'count': 1, 'crs': grid['crs'], 'transform': rasterio.Affine(*grid['transform']),
+                         'height': grid['height'], 'width': grid['width'], 'dtype': grid['dtype'],
+                         'nodata': grid['nodata']}, output_profile)
+
+
+def load_accumulator(path):
+    # Sidecars are .npz files holding running per-pixel arrays, the raster grid and the rasters folded in
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        accumulator = {key: data[key] for key in data.files}
+    accumulator['grid'] = json.loads(str(accumulator['grid']))
+    accumulator['files'] = list(accumulator['files'])
+    return accumulator
+
+
+def save_accumulator(path, accumulator):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    arrays = dict(accumulator, grid=json.dumps(accumulator['grid']), files=np.array(accumulator['files'], dtype=str))
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def new_accumulator(grid):
+    shape = (grid['height'], grid['width'])
+    return {'grid': grid, 'files': [], 'sum': np.zeros(shape), 'sum_squares': np.zeros(shape),
+            'count': np.zeros(shape, dtype='uint16')}
+
+
+def fold(accumulator, data, sign=1):
+    valid = np.isfinite(data)
+    values = np.where(valid, data, 0).astype(np.float64)
+    accumulator['sum'] += sign * values
+    accumulator['sum_squares'] += sign * values * values
+    if sign > 0:
+        accumulator['count'] += valid
+    else:
+        accumulator['count'] -= valid
+
+
+def accumulator_mean(accumulator):
+    mean = np.full(accumulator['sum'].shape, np.nan)
+    np.divide(accumulator['sum'], accumulator['count'], out=mean, where=accumulator['count'] > 0)
+    return mean
+
+
+def write_raster(path, array, grid, output_profile=DEFAULT_OUTPUT_PROFILE):
+    # Means and standard deviations are fractional and NaN where no day had data, whatever the source dtype
+    meta = output_meta(dict(grid, dtype='float32', nodata=np.nan), output_profile)
+    with stage('write', items=1, nbytes=array.nbytes), rasterio.open(path, 'w', **meta) as dst:
+        dst.write(array.astype('float32'), 1)
+
+
+def update_monthly_accumulators(grouped_files, folder_path, threshold_value, output_profile=DEFAULT_OUTPUT_PROFILE):
+    """
+    Fold rasters that are not yet part of their month's accumulator into its running sum, sum of
+    squares and count, then rewrite that month's mean and standard deviation.
+    """
+    accumulator_dir = os.path.join(folder_path, '.accumulators')
+    for month, files in sorted(grouped_files.items()):
+        path = os.path.join(accumulator_dir, f'accumulator_{month}.npz')
+        accumulator = load_accumulator(path)
+        folded = set(accumulator['files']) if accumulator else set()
+        new_files = [file for file in sorted(files) if os.path.basename(file) not in folded]
+        if not new_files:
+            continue
+
+        for file in new_files:
+            with stage('stack', items=1), rasterio.open(file) as src:
+                if accumulator is None:
+                    accumulator = new_accumulator(grid_of(src))
+                if grid_of(src) != accumulator['grid']:
+                    print(f"Skipping {file}: its grid does not match the accumulator for {month}")
+                    continue
+                fold(accumulator, read_thresholded(src, threshold_value))
+            accumulator['files'].append(os.path.basename(file))
+
+        mean = accumulator_mean(accumulator)
+        variance = np.full(mean.shape, np.nan)
+        np.divide(accumulator['sum_squares'], accumulator['count'], out=variance, where=accumulator['count'] > 0)
+        std = np.sqrt(np.maximum(variance - mean * mean, 0))
+        write_raster(os.path.join(folder_path, f'output_mean_{month}.tif'), mean, accumulator['grid'], output_profile)
+        write_raster(os.path.join(folder_path, f'output_std_{month}.tif'), std, accumulator['grid'], output_profile)
+        save_accumulator(path, accumulator)
+        print(f"Folded {len(new_files)} new rasters into {month}")
+
+
+def day_path(days_dir, day):
+    return os.path.join(days_dir, f'{day}.npz')
+
+
+def save_day(days_dir, day, data):
+    # Compressed, and written next to its final name first so a crash never leaves half a day
+    os.makedirs(days_dir, exist_ok=True)
+    path = day_path(days_dir, day)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, data=data)
+    os.replace(path + '.tmp', path)
+
+
+def load_day(days_dir, day):
+    with np.load(day_path(days_dir, day)) as data:
+        return data['data']
+
+
+def update_rolling_composites(dated_files, folder_path, threshold_value, window_days,
+                              output_profile=DEFAULT_OUTPUT_PROFILE):
+    """
+    Keep a rolling window_days mean. The sidecar holds the running sum and count and the days inside
+    the window. Each of those days is also kept as its own compressed file, and only the days that
+    leave the window are read back, to be subtracted again.
+    """
+    path = os.path.join(folder_path, '.accumulators', f'rolling_{window_days}d.npz')
+    days_dir = os.path.join(folder_path, '.accumulators', f'rolling_{window_days}d')
+    accumulator = load_accumulator(path)
+    if accumulator is not None:
+        accumulator['days'] = list(accumulator['days'])
+    expired = []
+
+    for file in sorted(dated_files, key=lambda f: parse_date_part(os.path.basename(f))):
+        day = parse_date_part(os.path.basename(file))
+        date = datetime.strptime(day, '%Y%j')
+        if accumulator is not None and (os.path.basename(file) in accumulator['files'] or day in accumulator['days']):
+            continue
+        with stage('stack', items=1), rasterio.open(file) as src:
+            if accumulator is None:
+                accumulator = dict(new_accumulator(grid_of(src)), days=[])
+            if grid_of(src) != accumulator['grid']:
+                print(f"Skipping {file}: its grid does not match the {window_days}-day accumulator")
+                continue
+            data = read_thresholded(src, threshold_value)
+
+        latest = max([datetime.strptime(d, '%Y%j') for d in accumulator['days']] + [date])
+        if date <= latest - timedelta(days=window_days):
+            print(f"Skipping {file}: older than the current {window_days}-day window")
+            accumulator['files'].append(os.path.basename(file))
+            continue
+        fold(accumulator, data)
+        save_day(days_dir, day, data)
+        accumulator['days'].append(day)
+        accumulator['files'].append(os.path.basename(file))
+
+        # Subtract the days that fell out of the window
+        kept = []
+        for old_day in accumulator['days']:
+            if datetime.strptime(old_day, '%Y%j') <= latest - timedelta(days=window_days):
+                fold(accumulator, load_day(days_dir, old_day), sign=-1)
+                expired.append(old_day)
+            else:
+                kept.append(old_day)
+        accumulator['days'] = kept
+
+        output_day = latest.strftime('%Y%j')
+        write_raster(os.path.join(folder_path, f'output_rolling_{window_days}d_{output_day}.tif'),
+                     accumulator_mean(accumulator), accumulator['grid'], output_profile)
+        print(f"Updated {window_days}-day composite ending {output_day}")
+
+    if accumulator is not None:
+        save_accumulator(path, dict(accumulator, days=np.array(accumulator['days'], dtype=str)))
+    # Expired days are only removed once the sidecar no longer lists them
+    for old_day in expired:
+        os.remove(day_path(days_dir, old_day))
 
 
 def process_tif_files(args):
+    if args.datacube:
+        stack_datacube(args.datacube, args.folder_path, args.threshold_value, args.mean_stacking, args.sigma_stacking,
+                       args.iters, args.sigma_value, args.block_rows, args.threads, args.output_profile,
+                       args.first_day, args.last_day)
+        return
+
     file_list = glob.glob(os.path.join(args.folder_path, '*.tif'))
+    if args.incremental or args.rolling_days:
+        grouped_files = group_files_by_month(file_list)
+        dated_files = [file for files in grouped_files.values() for file in files]
+        if args.incremental:
+            update_monthly_accumulators(grouped_files, args.folder_path, args.threshold_value, args.output_profile)
+        for window_days in args.rolling_days:
+            update_rolling_composites(dated_files, args.folder_path, args.threshold_value, window_days,
+                                      args.output_profile)
+        if args.delete_originals:
+            delete_original_files(dated_files)
+        return
+
     if args.monthly_stacking:
-        grouped_files = {}
-        for file in file_list:
-            base_name = os.path.basename(file)
-            try:
-                date_part = base_name.split('_')[1][:7]  # Assuming format 'Country_YYYYDDD'
-                month_key = julian_to_month(date_part)
-                if month_key not in grouped_files:
-                    grouped_files[month_key] = []
-                grouped_files[month_key].append(file)
-            except ValueError as e:
-                print(f"Skipping file {base_name} due to error: {e}")
+        grouped_files = group_files_by_month(file_list)
 
         for month, files in grouped_files.items():
-            data_arrays = []
-            reference_shape = None
-            metadata = None
-            for file in files:
-                with rasterio.open(file) as src:
-                    data = src.read(1).astype('float32')  # Read first band
-                    data[data > args.threshold_value] = np.nan
+            with contextlib.ExitStack() as stack:
+                datasets = []
+                reference_shape = None
+                metadata = None
+                for file in files:
+                    src = stack.enter_context(rasterio.open(file))
                     if reference_shape is None:
-                        reference_shape = data.shape
-                        metadata = src.meta.copy()
+                        reference_shape = src.shape
+                        metadata = profile_meta(src.meta, args.output_profile)
                         metadata.update(count=1)  # Ensure metadata is for single-band output
-                    if data.shape == reference_shape:
-                        data_arrays.append(data)
+                    if src.shape == reference_shape:
+                        datasets.append(src)
                     else:
-                        print(f"Skipping array from {file} due to shape mismatch: expected {reference_shape}, got {data.shape}")
+                        print(f"Skipping array from {file} due to shape mismatch: expected {reference_shape}, got {src.shape}")
 
-            if data_arrays:
-                stack_and_save(data_arrays, month, args.folder_path, metadata, args.mean_stacking, args.sigma_stacking, args.iters, args.sigma_value)
+                if datasets:
+                    stack_blocks(file_block_reader(datasets, args.threshold_value), reference_shape[0], month,
+                                 args.folder_path, metadata, args.mean_stacking, args.sigma_stacking, args.iters,
+                                 args.sigma_value, args.block_rows, args.threads)
             if args.delete_originals:
                 delete_original_files(files)
 
@@ -112,7 +506,8 @@ def process_tif_files(args):
 
 def main():
     args = parse_arguments()
-    process_tif_files(args)
+    with profiled(args.profile):
+        process_tif_files(args)
 
 
 if __name__ == "__main__":